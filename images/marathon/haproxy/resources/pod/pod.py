@@ -11,13 +11,16 @@
 #  disclosure agreement, expressly prescribing the scope and manner of
 #  such use.
 #
+import csv
 import json
 import logging
 import os
+import socket
 import time
 
 from jinja2 import Environment, FileSystemLoader
 from ochopod.bindings.generic.marathon import Pod
+from ochopod.core.fsm import diagnostic
 from ochopod.core.tools import Shell
 from ochopod.models.piped import Actor as Piped
 from ochopod.models.reactive import Actor as Reactive
@@ -61,12 +64,48 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
-
-            return \
+            metrics = \
                 {
                     'uptime': '%.2f hours (pid %s)' % (lapse, pid)
                 }
 
+            #
+            # - ask haproxy for its statistics via its unix socket (see haproxy.cfg), we get one CSV line per
+            #   frontend, backend & server
+            # - report the health of each of our downstream hooks plus the current traffic
+            #
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(5.0)
+                sock.connect('/var/run/haproxy.sock')
+                sock.sendall('show stat\n')
+                chunks = []
+                while 1:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+
+                sock.close()
+                lines = ''.join(chunks).lstrip('# ').splitlines()
+                rows = [row for row in csv.DictReader(lines) if row['pxname'] in ['http', 'local']]
+                servers = [row for row in rows if row['svname'] not in ['FRONTEND', 'BACKEND']]
+                frontend = next(row for row in rows if row['svname'] == 'FRONTEND')
+                metrics['backend'] = \
+                    {
+                        'up': sum(1 for row in servers if row['status'].startswith('UP')),
+                        'down': [row['svname'] for row in servers if not row['status'].startswith('UP')],
+                        'sessions': int(frontend['scur'] or 0),
+                        'requests/s': int(frontend['req_rate'] or 0),
+                        'errors': sum(int(row['econ'] or 0) + int(row['eresp'] or 0) for row in servers)
+                    }
+
+            except Exception as failure:
+
+                logger.warning('unable to query haproxy (%s)' % diagnostic(failure))
+
+            return metrics
+
         def can_configure(self, cluster):
 
             #
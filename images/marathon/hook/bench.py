@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import hashlib
+import hmac
+import httplib
+import json
+import time
+
+from argparse import ArgumentParser
+from threading import Thread
+from urlparse import urlparse
+
+
+def _post(host, port, token, n):
+
+    #
+    # - sign a minimal git push (spread over 100 repositories) the same way github does
+    #
+    js = \
+        {
+            'ref': 'refs/heads/master',
+            'after': hashlib.sha1(str(n)).hexdigest(),
+            'repository': {'full_name': 'bench/repo-%d' % (n % 100), 'name': 'repo-%d' % (n % 100), 'git_url': 'git://github.com/bench/repo.git'},
+            'commits': [{'message': 'bench', 'timestamp': '2015-08-20T12:00:00-07:00'}]
+        }
+
+    body = json.dumps(js)
+    headers = \
+        {
+            'Content-Type': 'application/json',
+            'X-Hub-Signature': 'sha1=' + hmac.new(token, body, hashlib.sha1).hexdigest()
+        }
+
+    http = httplib.HTTPConnection(host, port, timeout=60)
+    try:
+        http.request('POST', '/', body, headers)
+        return http.getresponse().status
+    finally:
+        http.close()
+
+
+def _get(host, port, where, wait=0, tag=None):
+
+    #
+    # - long-polls pass the etag they got back (otherwise the hook answers right away)
+    #
+    headers = {'Accept': 'application/json'}
+    if tag:
+        headers['If-None-Match'] = tag
+
+    http = httplib.HTTPConnection(host, port, timeout=60)
+    try:
+        http.request('GET', '%s?wait=%d' % (where, wait) if wait else where, headers=headers)
+        response = http.getresponse()
+        response.read()
+        return response.status, response.getheader('ETag')
+    finally:
+        http.close()
+
+
+if __name__ == '__main__':
+
+    #
+    # - hammer a hook with signed git pushes (POST /) and status polls (GET /status) for a while, using N
+    #   concurrent clients each opening a new connection per request (e.g like github & the pollers do)
+    # - optionally keep M long-polls (GET /status?wait=50) pending in the background
+    # - report the throughput & latency percentiles per route
+    #
+    parser = ArgumentParser(description='load benchmark for the hook endpoint')
+    parser.add_argument('url', type=str, help='hook url (e.g http://localhost:5000)')
+    parser.add_argument('-t', '--token', type=str, default='autodeskcloud', help='hook token used to sign the pushes')
+    parser.add_argument('-c', '--clients', type=int, default=32, help='# of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=30.0, help='duration in seconds')
+    parser.add_argument('-p', '--pollers', type=int, default=0, help='# of long-polls kept pending')
+    parser.add_argument('-s', '--status', type=str, default='/status/master/bench/repo-0', help='status url to poll')
+    args = parser.parse_args()
+
+    parsed = urlparse(args.url)
+    host, port = parsed.hostname, parsed.port or 80
+    samples = {'POST /': [], 'GET /status': []}
+    errors = {'POST /': 0, 'GET /status': 0}
+    stop = time.time() + args.duration
+
+    def _client(index):
+        n = index
+        while time.time() < stop:
+            route = 'POST /' if n % 2 else 'GET /status'
+            tick = time.time()
+            try:
+                code = _post(host, port, args.token, n) if n % 2 else _get(host, port, args.status)[0]
+                if code >= 500:
+                    errors[route] += 1
+                else:
+                    samples[route].append(time.time() - tick)
+
+            except Exception:
+                errors[route] += 1
+
+            n += args.clients
+
+    def _poller():
+        tag = None
+        while time.time() < stop:
+            try:
+                _, tag = _get(host, port, args.status, wait=50, tag=tag)
+            except Exception:
+                pass
+
+    for _ in range(args.pollers):
+        thread = Thread(target=_poller)
+        thread.daemon = True
+        thread.start()
+
+    threads = [Thread(target=_client, args=(index,)) for index in range(args.clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    lapse = time.time() - started
+    print '%-12s %8s %10s %10s %10s %8s' % ('route', 'requests', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors')
+    for route in sorted(samples):
+        ordered = sorted(samples[route])
+        pick = lambda q: 1000.0 * ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+        print '%-12s %8d %10.1f %10.1f %10.1f %8d' % (route, len(ordered), len(ordered) / lapse, pick(0.5), pick(0.99), errors[route])
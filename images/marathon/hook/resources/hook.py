@@ -21,238 +21,948 @@ import logging
 import ochopod
 import os
 import redis
-import requests
-import sys
+import time
+import zlib
 
-from flask import Flask, request
+from fnmatch import fnmatch
+from flask import Flask, Response, g, request
+from metrics import Metrics, WAITS
+from notify import Notifier
 from ochopod.core.fsm import diagnostic
-from random import choice
+from threading import Thread
 
 logger = logging.getLogger('ochopod')
 
+#: our flask endpoint (served by gunicorn)
 web = Flask(__name__)
 
+#: marker terminating the log:<key> list once the build is over (must match the slave)
+EOF = '\x00'
 
-if __name__ == '__main__':
+#
+# - parse our ochopod hints
+# - enable CLI logging
+# - parse our $pod settings (defined in the pod yml)
+# - grab redis & connect to it
+#
+hints = json.loads(os.environ['ochopod'])
+ochopod.enable_cli_log(debug=hints['debug'] == 'true')
+settings = json.loads(os.environ['pod'])
+tokens = os.environ['redis'].split(':')
+client = redis.StrictRedis(host=tokens[0], port=int(tokens[1]), db=0)
+
+#
+# - we got a tally of how many pods we have for each slave category
+# - we'll use it to perform the module and shard the queues
+#
+slaves = json.loads(os.environ['slaves'])
+
+#
+# - our prometheus-style metrics, accumulated by each worker and periodically flushed to redis
+#
+metrics = Metrics(client, 'metrics:hook')
+metrics.declare('hook_requests_total', 'counter', 'HTTP requests per route and status code')
+metrics.declare('hook_request_seconds', 'histogram', 'HTTP request latency per route')
+metrics.declare('hook_hmac_seconds', 'histogram', 'git push HMAC verification time')
+metrics.declare('hook_redis_seconds', 'histogram', 'redis round-trip latency per operation')
+metrics.declare('hook_queue_depth', 'gauge', '# of builds waiting in each slave queue')
+metrics.declare('hook_queue_oldest_seconds', 'gauge', 'age of the oldest build waiting in each slave queue')
+metrics.declare('hook_queue_wait_seconds', 'histogram', 'time spent by builds in the queues per lane (fed by the slaves)', buckets=WAITS)
+metrics.declare('hook_admission_total', 'counter', 'builds queued, coalesced, deferred (throttled) or released')
+metrics.declare('hook_admission_burst', 'gauge', 'token bucket burst per scope')
+metrics.declare('hook_admission_rate', 'gauge', 'token bucket refill rate per scope (builds per minute)')
+metrics.declare('hook_deferred_builds', 'gauge', '# of throttled builds waiting to be released')
+metrics.declare('hook_builds_stolen_total', 'counter', 'builds stolen by idle slaves from their siblings (fed by the slaves)')
+metrics.declare('hook_prefetches_total', 'counter', 'commits fetched ahead of their build by the slaves (fed by the slaves)')
+metrics.declare('hook_notifier_sent_total', 'counter', 'slack notification lines posted to the relay')
+metrics.declare('hook_notifier_dropped_total', 'counter', 'slack notification lines dropped (notifier queue full)')
+metrics.declare('hook_notifier_overflow_total', 'counter', 'slack notification lines rejected by the relay (at capacity)')
+metrics.declare('hook_notifier_failed_total', 'counter', 'slack notification lines that could not be posted')
+
+#
+# - our slack relay notifications are queued & posted asynchronously
+# - count what happens to them in our metrics
+#
+_slack = Notifier('http://%s' % os.environ['slack'], counted=lambda outcome, lines: metrics.inc('hook_notifier_%s_total' % outcome, lines))
+
+#
+# - index the capabilities offered by each slave cluster once and for all
+# - the slave clusters are named slave-[<token>]* where each token is a capability
+# - the clusters matching a given capabilities string are then memoized in candidates{}
+#
+offered = {tag: frozenset(tag.split('-')) for tag in slaves}
+candidates = {None: sorted(slaves.keys())}
+
+#
+# - a repository will stick to the slave cluster it was last keyed to unless its queue is deeper than
+#   the least loaded candidate by more than this many builds
+#
+stickiness = int(settings['stickiness']) if 'stickiness' in settings else 2
+
+#
+# - each slave queue is split into priority lanes (highest first), see _queue()
+# - the lane is picked using the X-Priority header (POST /build only), then the repository and finally the
+#   branch, each of those being matched against the patterns defined in the pod settings
+#
+LANES = ['high', 'normal', 'low']
+priorities = settings['priorities'] if 'priorities' in settings else {}
+
+#
+# - we only store the fields the slave needs from each git push (optionally compressed)
+# - the raw payload can be kept as well under raw:<key> if need be
+#
+compress = 'compress' in settings and settings['compress'] in [True, 'true']
+keep = 'raw' in settings and settings['raw'] in [True, 'true']
+
+#
+# - admission control : each repository and each organization gets a token bucket (burst & refill rate
+#   in builds per minute), no limit by default
+# - a build is queued only if both buckets have a token left, otherwise it is deferred (see enqueue below)
+# - a bucket holding less than one token would defer its builds forever
+#
+throttling = settings['throttling'] if 'throttling' in settings else {}
+limits = {scope: throttling[scope] for scope in ['repo', 'org'] if scope in throttling and float(throttling[scope]['rate']) > 0}
+for scope, cfg in limits.items():
+    assert float(cfg['burst']) >= 1, 'the %s throttling burst must be at least 1' % scope
+
+#
+# - optionally cancel the build in progress for a given branch/repository upon a new git push
+#
+supersede = 'supersede' in settings and settings['supersede'] in [True, 'true']
+
+#
+# - lua helper refilling & consuming our token buckets (shared by the scripts below)
+# - buckets are passed as a list of [key, burst, rate per second]
+# - returns 0 if a token was consumed in each bucket, otherwise how many seconds to wait (and nothing is
+#   consumed)
+# - the current time is passed by the caller (redis 2.8 refuses writes after calling TIME)
+# - the bucket keys must be declared : declared() substitutes KEYS[first], KEYS[first + 1], ... to the keys of
+#   a list of buckets (in order)
+#
+ADMIT = """
+    local function declared(first, buckets)
+        local substituted = {}
+        for i, bucket in ipairs(buckets) do
+            substituted[i] = {KEYS[first + i - 1], bucket[2], bucket[3]}
+        end
+        return substituted
+    end
+    local function admit(buckets, now)
+        local wait = 0
+        local levels = {}
+        for i, bucket in ipairs(buckets) do
+            local state = redis.call('hmget', bucket[1], 'tokens', 'ts')
+            local tokens = tonumber(state[1]) or bucket[2]
+            local ts = tonumber(state[2]) or now
+            levels[i] = math.min(bucket[2], tokens + (now - ts) * bucket[3])
+            if levels[i] < 1 then
+                wait = math.max(wait, (1 - levels[i]) / bucket[3])
+            end
+        end
+        if wait > 0 then
+            return wait
+        end
+        for i, bucket in ipairs(buckets) do
+            redis.call('hmset', bucket[1], 'tokens', levels[i] - 1, 'ts', now)
+            redis.call('expire', bucket[1], math.ceil(bucket[2] / bucket[3]) + 60)
+        end
+        return 0
+    end
+"""
+
+#
+# - server-side lua script used to queue a build in one round-trip
+# - optionally update the git push data and the slave cluster for that key
+# - then coalesce with any build already pending for that key in that same queue (the slave always builds
+#   whatever git:<key> holds when it pops the entry, so queueing another one would just rebuild the same sha)
+#   or already deferred
+# - a build pending in another queue (e.g different lane or cluster) is superseded : pending:<key> now points
+#   to the new queue and the slave will skip the stale entry
+# - a reset request is recorded under reset:<key> (the slave will consume it)
+# - if throttled the build is deferred : it is recorded in the deferred sorted set (scored by when it can be
+#   released) and its latest entry kept in the deferred:builds hash
+# - returns how many builds were collapsed so far, 0 if the build was queued or minus the # of milliseconds it
+#   was deferred for
+#
+# - KEYS -> git:<key>, slave:<key>, pending:<key>, collapsed:<key>, reset:<key>, queue, deferred, deferred:builds,
+#           followed by the bucket keys (in the same order as in the deferred entry)
+# - ARGV -> git push data (or empty), slave cluster, build JSON, reset flag, key, current time, deferred entry JSON
+#
+enqueue = client.register_script(ADMIT + """
+    if ARGV[1] ~= '' then
+        redis.call('set', KEYS[1], ARGV[1])
+        redis.call('set', KEYS[2], ARGV[2])
+    end
+    if ARGV[4] == '1' then
+        redis.call('set', KEYS[5], 1)
+    end
+    if redis.call('get', KEYS[3]) == KEYS[6] then
+        return redis.call('incr', KEYS[4])
+    end
+    if redis.call('zscore', KEYS[7], ARGV[5]) then
+        redis.call('hset', KEYS[8], ARGV[5], ARGV[7])
+        return redis.call('incr', KEYS[4])
+    end
+    local wait = admit(declared(9, cjson.decode(ARGV[7]).buckets), tonumber(ARGV[6]))
+    if wait > 0 then
+        redis.call('hset', KEYS[8], ARGV[5], ARGV[7])
+        redis.call('zadd', KEYS[7], tonumber(ARGV[6]) + wait, ARGV[5])
+        return -math.ceil(wait * 1000)
+    end
+    redis.call('set', KEYS[3], KEYS[6])
+    redis.call('rpush', KEYS[6], ARGV[3])
+    return 0
+""")
 
+#
+# - server-side lua script used to release one deferred build whose time has come
+# - the caller reads the deferred entry first in order to declare the keys it touches, the entry is left
+#   alone if it changed meanwhile (the caller will retry on its next pass) and dropped if it is gone
+# - the build is re-admitted against its buckets (and deferred again if still throttled)
+# - then queued (or coalesced) exactly like enqueue does
+# - returns 1 if the build was released, 0 otherwise
+#
+# - KEYS -> deferred, deferred:builds, pending:<key>, collapsed:<key>, queue, followed by the bucket keys (in the
+#           same order as in the deferred entry), only the first 4 if the entry is gone
+# - ARGV -> key, current time, deferred entry JSON (as read by the caller, empty if gone)
+#
+release = client.register_script(ADMIT + """
+    local js = redis.call('hget', KEYS[2], ARGV[1])
+    if not js then
+        redis.call('zrem', KEYS[1], ARGV[1])
+        return 0
+    end
+    if js ~= ARGV[3] then
+        return 0
+    end
+    local now = tonumber(ARGV[2])
+    local entry = cjson.decode(js)
+    local wait = admit(declared(6, entry.buckets), now)
+    if wait > 0 then
+        redis.call('zadd', KEYS[1], now + wait, ARGV[1])
+        return 0
+    end
+    redis.call('zrem', KEYS[1], ARGV[1])
+    redis.call('hdel', KEYS[2], ARGV[1])
+    if redis.call('get', KEYS[3]) == KEYS[5] then
+        redis.call('incr', KEYS[4])
+    else
+        redis.call('set', KEYS[3], KEYS[5])
+        redis.call('rpush', KEYS[5], entry.build)
+    end
+    return 1
+""")
+
+#
+# - server-side lua script used to cancel the build in progress for a given key
+# - the slave records the id of the build it is running under running:<key> and polls cancel:<key>
+# - store that id under cancel:<key> (the slave only honors it if it matches its own build) and let it
+#   expire after an hour
+# - returns the build id (or nothing if no build is in progress)
+#
+# - KEYS -> running:<key>, cancel:<key>
+#
+cancel = client.register_script("""
+    local running = redis.call('get', KEYS[1])
+    if running then
+        redis.call('set', KEYS[2], running, 'EX', 3600)
+    end
+    return running
+""")
+
+
+def _shard(path, modulo):
+
+    #
+    # - rendezvous hashing : score each queue index against the repository using a md5 digest
+    #   and pick the highest one
+    # - do not use hash() which is not stable across interpreters
+    # - growing from N to N+1 slaves will only re-assign ~1/(N+1) repositories (e.g only those now
+    #   scoring highest on the new queue)
+    #
+    return max(range(modulo), key=lambda index: hashlib.md5('%s#%d' % (path, index)).digest())
+
+
+def _queue(cluster, qid, lane):
+
+    #
+    # - the normal lane is the historical queue-<cluster>-<qid> list
+    # - the other lanes are suffixed with their name
+    #
+    queue = 'queue-%s-%d' % (cluster, qid)
+    return queue if lane == 'normal' else '%s-%s' % (queue, lane)
+
+
+def _lane(branch, path, requested=None):
+
+    #
+    # - an explicit (valid) lane always wins
+    # - otherwise match the repository & then the branch against the patterns from our settings
+    # - if several patterns match pick the highest lane
+    #
+    if requested in LANES:
+        return requested
+
+    for category, name in [('repos', path), ('branches', branch)]:
+        patterns = priorities[category] if category in priorities else {}
+        matching = [LANES.index(lane) for pattern, lane in patterns.items() if lane in LANES and fnmatch(name, pattern)]
+        if matching:
+            return LANES[min(matching)]
+
+    return 'normal'
+
+
+def _project(js):
+
+    #
+    # - trim the git push payload down to what the slave actually uses
+    # - keep the same layout so that the slave can parse either
+    # - compress if requested (the slave will detect it, JSON always starts with a '{')
+    #
+    cfg = js['repository']
+    projected = \
+        {
+            'repository': {field: cfg[field] for field in ['full_name', 'name', 'git_url']},
+            'after': js['after'],
+            'commits': [{field: commit[field] for field in ['message', 'timestamp']} for commit in js['commits'][:1]]
+        }
+
+    serialized = json.dumps(projected, separators=(',', ':'))
+    return zlib.compress(serialized) if compress else serialized
+
+
+def _match(capabilities):
+
+    #
+    # - try to match the requested capabilities against what the various slaves offer
+    # - sort the matching clusters from the most specific to the least specific
+    #
+    if capabilities not in candidates:
+        caps = set(capabilities.split('+'))
+        matching = [tag for tag, offer in offered.items() if caps.issubset(offer)]
+        candidates[capabilities] = sorted(matching, key=lambda item: (len(item), item))
+
+    return candidates[capabilities]
+
+
+def _dispatch(key, path, matching):
+
+    #
+    # - look at the queue each candidate cluster would use for that repository
+    # - fetch their depth (all lanes included) plus the cluster the repository was last keyed to in one round-trip
+    #
+    qids = {tag: _shard(path, slaves[tag]) for tag in matching}
+    if len(matching) == 1:
+        return matching[0], qids[matching[0]]
+
+    pipe = client.pipeline(transaction=False)
+    pipe.get('slave:%s' % key)
+    for tag in matching:
+        for lane in LANES:
+            pipe.llen(_queue(tag, qids[tag], lane))
+    with metrics.timed('hook_redis_seconds', op='dispatch'):
+        replies = pipe.execute()
+
+    last = replies[0]
+    depths = {tag: sum(replies[1 + n * len(LANES):1 + (n + 1) * len(LANES)]) for n, tag in enumerate(matching)}
+
+    #
+    # - pick the least loaded cluster
+    # - break ties using a md5 digest of the repository to splay new repositories out
+    # - stick to the previous cluster if it is not much more loaded (we want to keep using the slave
+    #   that has the repository cached)
+    #
+    cluster = min(matching, key=lambda tag: (depths[tag], hashlib.md5('%s#%s' % (path, tag)).digest()))
+    if last in depths and depths[last] - depths[cluster] <= stickiness:
+        cluster = last
+
+    logger.debug('dispatching %s -> %s (depths %s)' % (key, cluster, depths))
+    return cluster, qids[cluster]
+
+
+def _enqueue(key, cluster, qid, build, payload=''):
+
+    #
+    # - run our lua script against the lane the build was assigned to
+    # - pass the git push data if we just received it
+    # - pass the token buckets for the repository & its organization
+    #
+    to = _queue(cluster, qid, build['lane'])
+    path = key.split(':', 1)[1]
+    names = {'repo': path, 'org': path.split('/')[0]}
+    buckets = [['bucket:%s:%s' % (scope, names[scope]), float(cfg['burst']), float(cfg['rate']) / 60.0] for scope, cfg in limits.items()]
+    entry = \
+        {
+            'queue': to,
+            'build': json.dumps(build),
+            'buckets': buckets
+        }
+
+    with metrics.timed('hook_redis_seconds', op='enqueue'):
+        code = enqueue(
+            keys=['git:%s' % key, 'slave:%s' % key, 'pending:%s' % key, 'collapsed:%s' % key, 'reset:%s' % key, to, 'deferred', 'deferred:builds'] + [bucket[0] for bucket in buckets],
+            args=[payload, cluster, json.dumps(build), 1 if build.get('reset') else 0, key, time.time(), json.dumps(entry)])
+
+    if code > 0:
+        outcome = 'coalesced'
+        logger.debug('coalesced build @ %s -> %s (%d collapsed)' % (key, to, code))
+
+    elif code < 0:
+        outcome = 'deferred'
+        logger.debug('throttled build @ %s -> %s (deferred by %d ms)' % (key, to, -code))
+
+    else:
+        outcome = 'queued'
+        logger.debug('requested build @ %s -> %s' % (key, to))
+
+    metrics.inc('hook_admission_total', outcome=outcome)
+    return outcome
+
+
+def _release():
+
+    #
+    # - periodically release whatever deferred build is due (each worker does it, the lua script is atomic)
+    # - look up to 16 due builds up and release them one by one, declaring the keys each of them touches
+    #
+    while 1:
+        time.sleep(1.0)
+        try:
+            now = time.time()
+            due = client.zrangebyscore('deferred', '-inf', now, start=0, num=16)
+            if not due:
+                continue
+
+            released = 0
+            for key, js in zip(due, client.hmget('deferred:builds', due)):
+                keys = ['deferred', 'deferred:builds', 'pending:%s' % key, 'collapsed:%s' % key]
+                if js:
+                    entry = json.loads(js)
+                    keys += [entry['queue']] + [bucket[0] for bucket in entry['buckets']]
+
+                released += release(keys=keys, args=[key, now, js or ''])
+
+            if released:
+                metrics.inc('hook_admission_total', released, outcome='released')
+                logger.debug('released %d deferred build(s)' % released)
+
+        except Exception as failure:
+
+            logger.warning('unable to release deferred builds (%s)' % diagnostic(failure))
+
+
+#
+# - each worker runs its own release loop
+# - only bother if throttling is configured (or if builds deferred while it was are still pending)
+#
+if limits or client.zcard('deferred'):
+    releaser = Thread(target=_release)
+    releaser.daemon = True
+    releaser.start()
+
+
+def _etag(base, raw):
+
+    #
+    # - the entity tag is the status sha plus its completion time
+    # - tag the text & json representations differently
+    #
+    return '%s-%s' % (base, 'txt' if raw else 'json') if base is not None else None
+
+
+def _base(payload):
+
+    #
+    # - derive the <sha>-<completed> base from a status payload (only for archived builds or for statuses
+    #   stored before etag:<key> existed)
+    #
+    if payload is None:
+        return None
+
+    js = json.loads(payload)
+    return '%s-%d' % (js['sha'], js.get('completed', js['seconds']))
+
+
+def _current(key):
+
+    #
+    # - the slave stores the <sha>-<completed> base under etag:<key> next to status:<key>
+    # - this lets us answer polls without fetching & parsing the status (and its whole log)
+    #
+    base = client.get('etag:%s' % key)
+    return base if base is not None else _base(client.get('status:%s' % key))
+
+
+def _wait(key, base, seconds):
+
+    #
+    # - subscribe to the status:<key> channel the slave publishes to upon completion
+    # - re-read the tag once subscribed in case it changed in the meantime
+    # - block until notified or until the timeout expires
+    #
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('status:%s' % key)
     try:
+        deadline = time.time() + seconds
+        current = _current(key)
+        while current == base:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+
+            if pubsub.get_message(timeout=left):
+                current = _current(key)
+
+        return current
+
+    finally:
+        pubsub.close()
+
+
+def _archived(key, sha):
 
-        def _slack(line):
+    #
+    # - the build history for a given key is made of a sorted set of shas (scored by completion time)
+    #   plus a hash mapping each sha to its compressed status
+    # - accept abbreviated shas by matching them against the (capped) sorted set
+    #
+    if len(sha) < 40:
+        matching = [item for item in client.zrange('history:%s' % key, 0, -1) if item.startswith(sha)]
+        if len(matching) != 1:
+            return None
 
-            headers = \
-                {
-                    'Content-Type': 'application/json'
-                }
+        sha = matching[0]
 
-            requests.post('http://%s' % os.environ['slack'], data=line, headers=headers)
+    compressed = client.hget('builds:%s' % key, sha)
+    return zlib.decompress(compressed) if compressed is not None else None
+
+
+@web.before_request
+def _before():
+
+    g.tick = time.time()
+
+
+@web.after_request
+def _after(response):
+
+    #
+    # - label each request with its method plus the flask rule it matched
+    # - long-polls (?wait=<seconds>) are labelled separately : they mostly measure how long the caller waited
+    #
+    route = '%s %s' % (request.method, request.url_rule.rule if request.url_rule else '?')
+    if 'wait' in request.args:
+        route += ' (long-poll)'
+
+    metrics.inc('hook_requests_total', route=route, code=response.status_code)
+    metrics.observe('hook_request_seconds', time.time() - g.tick, route=route)
+    return response
+
+
+@web.route('/metrics', methods=['GET'])
+def _metrics():
+
+    #
+    # - look at each slave queue : fetch its depth & its oldest build in one round-trip
+    # - the hook timestamps each build when queueing it
+    #
+    now = time.time()
+    queues = [_queue(cluster, index, lane) for cluster in sorted(slaves) for index in range(slaves[cluster]) for lane in LANES]
+    pipe = client.pipeline(transaction=False)
+    for queue in queues:
+        pipe.llen(queue)
+        pipe.lindex(queue, 0)
+    pipe.zcard('deferred')
+    replies = pipe.execute()
+
+    gauges = [('hook_deferred_builds', {}, replies[-1])]
+    for queue, depth, oldest in zip(queues, replies[0:-1:2], replies[1:-1:2]):
+        age = now - json.loads(oldest).get('queued', now) if oldest else 0.0
+        gauges += [('hook_queue_depth', {'queue': queue}, depth), ('hook_queue_oldest_seconds', {'queue': queue}, age)]
+
+    for scope, cfg in limits.items():
+        gauges += [('hook_admission_burst', {'scope': scope}, cfg['burst']), ('hook_admission_rate', {'scope': scope}, cfg['rate'])]
+
+    return metrics.render(gauges), 200, \
+        {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+        }
+
+
+@web.route('/ping', methods=['GET'])
+def _ping():
+
+    return '', 200
+
+
+@web.route('/status/<branch>/<path:path>', methods=['GET'])
+def _status(branch, path):
+
+    logger.info('HTTP -> GET /status/%s/%s' % (branch, path))
+
+    #
+    # - force a json output if the Accept header matches 'application/json'
+    # - otherwise default to a text/plain response
+    # - the repository is always <owner>/<name> : any extra trailing token is a commit sha, in which
+    #   case we look the status for that specific build up in the history
+    #
+    sha = None
+    if path.count('/') > 1:
+        path, sha = path.rsplit('/', 1)
+
+    key = '%s:%s' % (branch, path)
+    raw = request.accept_mimetypes.best_match(['application/json']) is None
+    payload = None
+    with metrics.timed('hook_redis_seconds', op='status'):
+        if sha:
+            payload = _archived(key, sha)
+            base = _base(payload)
+        else:
+            base = _current(key)
+
+    #
+    # - if ?wait=<seconds> is specified and the caller already has the current status (or if there is
+    #   no status yet) long-poll until it changes
+    # - cap the wait to 50 seconds (haproxy times the server out after 60 seconds)
+    #
+    wait = min(request.args.get('wait', 0, type=float), 50.0)
+    if wait > 0 and not sha and (base is None or request.if_none_match.contains(_etag(base, raw))):
+        base = _wait(key, base, wait)
+
+    if base is None:
+        return '', 404
+
+    #
+    # - fast-fail on a HTTP 304 if the caller already has the current status (without ever fetching it)
+    #
+    headers = \
+        {
+            'ETag': '"%s"' % _etag(base, raw),
+            'Cache-Control': 'no-cache'
+        }
+
+    if request.if_none_match.contains(_etag(base, raw)):
+        return '', 304, headers
+
+    #
+    # - otherwise fetch the tag & status together (the slave sets both in one transaction) so that the
+    #   ETag we return always matches the payload
+    #
+    if not sha:
+        with metrics.timed('hook_redis_seconds', op='status'):
+            stored, payload = client.mget('etag:%s' % key, 'status:%s' % key)
+        if payload is None:
+            return '', 404
+
+        base = stored if stored is not None else _base(payload)
+        headers['ETag'] = '"%s"' % _etag(base, raw)
+
+    if raw:
 
         #
-        # - parse our ochopod hints
-        # - enable CLI logging
-        # - grab redis & connect to it
+        # - if 'application/json' was not requested simply dump the log as is
+        # - force the response code to be HTTP 412 upon failure and HTTP 200 otherwise
         #
-        hints = json.loads(os.environ['ochopod'])
-        ochopod.enable_cli_log(debug=hints['debug'] == 'true')
-        tokens = os.environ['redis'].split(':')
-        client = redis.StrictRedis(host=tokens[0], port=int(tokens[1]), db=0)
+        js = json.loads(payload)
+        code = 200 if js['ok'] else 412
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        return '\n'.join(js['log']), code, headers
+
+    else:
 
         #
-        # - we got a tally of how many pods we have for each slave category
-        # - we'll use it to perform the module and shard the queues
+        # - if 'application/json' was requested always respond with a HTTP 200
+        # - the response body then contains our serialized JSON output
         #
-        slaves = json.loads(os.environ['slaves'])
-
-        @web.route('/ping', methods=['GET'])
-        def _ping():
-
-            return '', 200
-
-        @web.route('/status/<branch>/<path:path>', methods=['GET'])
-        def _status(branch, path):
-
-            logger.info('HTTP -> GET /status/%s/%s' % (branch, path))
-
-            #
-            # - force a json output if the Accept header matches 'application/json'
-            # - otherwise default to a text/plain response
-            #
-            key = '%s:%s' % (branch, path)
-            raw = request.accept_mimetypes.best_match(['application/json']) is None
-            payload = client.get('status:%s' % key)
-            if payload is None:
-                return '', 404
-
-            if raw:
-
-                #
-                # - if 'application/json' was not requested simply dump the log as is
-                # - force the response code to be HTTP 412 upon failure and HTTP 200 otherwise
-                #
-                js = json.loads(payload)
-                code = 200 if js['ok'] else 412
-                return '\n'.join(js['log']), code, \
-                    {
-                        'Content-Type': 'text/plain; charset=utf-8'
-                    }
-
-            else:
-
-                #
-                # - if 'application/json' was requested always respond with a HTTP 200
-                # - the response body then contains our serialized JSON output
-                #
-                return payload, 200, \
-                    {
-                        'Content-Type': 'application/json; charset=utf-8'
-                    }
-
-        @web.route('/', methods=['POST'], defaults={'capabilities': None})
-        @web.route('/<capabilities>', methods=['POST'])
-        def _git_hook(capabilities):
-
-            logger.info('HTTP -> POST /')
-
-            #
-            # - if we have no build slaves, fast-fail on a 304
-            #
-            if not slaves:
-                return '', 304
-
-            #
-            # - we want the hook to be signed
-            # - fail on a HTTP 403 if not
-            #
-            if not 'X-Hub-Signature' in request.headers:
-                return '', 403
-
-            #
-            # - compute the HMAC and compare (use our pod token as the key)
-            # - fail on a 403 if mismatch
-            #
-            digest = 'sha1=' + hmac.new(os.environ['token'], request.data, hashlib.sha1).hexdigest()
-            if digest != request.headers['X-Hub-Signature']:
-                return '', 403
-
-            #
-            # - retrieve the branch
-            #
-            logger.debug('git payload -> %s' % request.data)
-            js = json.loads(request.data)
-            branch = js['ref'].split('/')[-1]
-
-            if capabilities is None:
-
-                #
-                # - no specific capability requested, just pick a slave cluster at random
-                #
-                cluster = choice(slaves.keys())
-
-            else:
-
-                #
-                # - look at our slave dependencies
-                # - try to match the requested capabilities against what the various slaves offer
-                # - the slave clusters are named slave-[<token>]* where each token is a capability
-                #
-                cluster = None
-                caps = set(capabilities.split('+'))
-                for tag in sorted(slaves.keys(), key=lambda item: (len(item), item)):
-                    offered = set(tag.split('-'))
-                    logger.debug(caps)
-                    logger.debug(offered)
-                    if caps.issubset(offered):
-                        cluster = tag
-                        break
-
-            #
-            # - if we couldn't find a match abort on a 304
-            # - otherwise use the # of slaves in that cluster as our modulo
-            #
-            if not cluster:
-                logger.info('unable to find a slave (capabilities -> %s)' % capabilities)
-                return '', 304
-
-            #
-            # - hash the data from git to send it to a specific queue
-            # - we do this to splay out the traffic amongst our slaves while retaining stickiness
-            #
-            cfg = js['repository']
-            path = cfg['full_name']
-            modulo = slaves[cluster]
-            qid = hash(path) % modulo
-            key = '%s:%s' % (branch, path)
-            client.set('git:%s' % key, request.data)
-            client.set('slave:%s' % key, cluster)
-            logger.debug('updated git push data @ %s' % key)
-            _slack(':rocket: git push for *%s* (%s), keyed @ _%s_' % (key, branch, cluster))
-
-            build = \
-                {
-                    'key':    key,
-                    'branch': branch
-                }
-
-            to = 'queue-%s-%d' % (cluster, qid)
-            client.rpush(to, json.dumps(build))
-            logger.debug('requested build @ %s -> %s' % (key, to))
-            return '', 200
-
-        @web.route('/build/<branch>/<path:path>', methods=['POST'])
-        def _build(branch, path):
-
-            logger.info('HTTP -> POST /build/%s/%s' % (branch, path))
-
-            #
-            # - if we have no build slaves, fast-fail on a 304
-            #
-            if not slaves:
-                return '', 304
-
-            #
-            # - look the specified repository up
-            # - fail on a 404 if not found
-            #
-            key = '%s:%s' % (branch, path)
-            payload = client.get('git:%s' % key)
-            if payload is None:
-                return '', 404
-
-            #
-            # -
-            #
-            cluster = client.get('slave:%s' % key)
-            assert cluster is not None, 'slave:%s not found in redis (bug ?)' % key
-            if cluster not in slaves:
-                return '', 304
-
-            modulo = slaves[cluster]
-            qid = hash(path) % modulo
-            _slack(':rocket: HTTP request for *%s* (%s), keyed @ _%s_' % (key, branch, cluster))
-
-            #
-            # - simply push they key to the appropriate queue
-            #
-            reset = 'X-Reset' in request.headers and request.headers['X-Reset'] == 'true'
-            build = \
-                {
-                    'key': key,
-                    'branch': branch,
-                    'reset': reset
-                }
-
-            client.rpush('queue-%s-%d' % (cluster, qid), json.dumps(build))
-            logger.debug('requested build @ %s -> %s' % (key, cluster))
-            return '', 200
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        return payload, 200, headers
+
+
+@web.route('/history/<branch>/<path:path>', methods=['GET'])
+def _history(branch, path):
+
+    logger.info('HTTP -> GET /history/%s/%s' % (branch, path))
+
+    #
+    # - page through the build history, most recent first
+    # - ?limit=<n> caps the # of builds returned (20 by default, 100 max)
+    # - ?before=<milliseconds> only returns builds completed strictly before that time
+    #
+    key = '%s:%s' % (branch, path)
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    before = request.args.get('before', None, type=int)
+    top = '(%d' % before if before is not None else '+inf'
+    scored = client.zrevrangebyscore('history:%s' % key, top, '-inf', start=0, num=limit, withscores=True)
+    if not scored:
+        return '', 404
+
+    #
+    # - summarize each build (the full status can be retrieved via GET /status/<branch>/<path>/<sha>)
+    # - pass the completion time of the last one as the cursor to use to get the next page
+    #
+    builds = []
+    compressed = client.hmget('builds:%s' % key, [sha for sha, _ in scored])
+    for (sha, completed), blob in zip(scored, compressed):
+        if blob is None:
+            continue
+
+        js = json.loads(zlib.decompress(blob))
+        builds.append(
+            {
+                'sha': sha,
+                'ok': js['ok'],
+                'seconds': js['seconds'],
+                'completed': int(completed)
+            })
+
+    js = \
+        {
+            'builds': builds,
+            'before': int(scored[-1][1]) if len(scored) == limit else None
+        }
+
+    return json.dumps(js), 200, \
+        {
+            'Content-Type': 'application/json; charset=utf-8'
+        }
+
+
+@web.route('/timings/<path:path>', methods=['GET'])
+def _timings(path):
+
+    logger.info('HTTP -> GET /timings/%s' % path)
+
+    #
+    # - the slaves keep rolling p50/p95 aggregates for each build phase (clone, checkout, steps, etc.) per
+    #   repository, each stored as JSON in the timings:<repo> hash
+    #
+    phases = client.hgetall('timings:%s' % path)
+    if not phases:
+        return '', 404
+
+    js = {phase: json.loads(blob) for phase, blob in phases.items()}
+    return json.dumps(js), 200, \
+        {
+            'Content-Type': 'application/json; charset=utf-8'
+        }
+
+
+@web.route('/log/<branch>/<path:path>', methods=['GET'])
+def _tail(branch, path):
+
+    logger.info('HTTP -> GET /log/%s/%s' % (branch, path))
+
+    #
+    # - the slave mirrors its build log line by line to log:<id> while the build runs (one list per build)
+    # - tail:<key> points to the id of the latest build for that key
+    # - stream as server-sent events if 'text/event-stream' is accepted, otherwise as chunked text/plain
+    # - start from ?offset=<line> of build ?build=<id> (the latest one by default)
+    # - SSE event ids are <id>/<line> : when reconnecting (Last-Event-ID header) resume the same build
+    # - ignore any malformed Last-Event-ID (e.g fall back on ?build & ?offset)
+    # - fail on a 404 if there is nothing to tail
+    #
+    key = '%s:%s' % (branch, path)
+    sse = request.accept_mimetypes.best == 'text/event-stream'
+    ident = request.args.get('build', None)
+    offset = request.args.get('offset', 0, type=int)
+    tokens = request.headers.get('Last-Event-ID', '').rsplit('/', 1) if sse else []
+    if len(tokens) == 2 and tokens[0] and tokens[1].isdigit():
+        ident = tokens[0]
+        offset = int(tokens[1]) + 1
+
+    ident = ident or client.get('tail:%s' % key)
+    if not ident or not client.exists('log:%s' % ident):
+        return '', 404
+
+    def _stream(offset):
 
         #
-        # - run our flask endpoint on TCP 5000
+        # - subscribe to log:<id> first, then read whatever is past our offset
+        # - wait for the slave to notify us before reading again
+        # - stop upon reaching the EOF marker (SSE streams then send an 'eof' event to tell the client not to
+        #   reconnect)
+        # - also stop after 50 seconds without a new line (haproxy times the server out after 60 seconds), in
+        #   which case the caller can simply resume from where it left
         #
-        web.run(host='0.0.0.0', port=5000)
-
-    except Exception as failure:
-
-        logger.fatal('unexpected condition -> %s' % diagnostic(failure))
-
-    finally:
-
-        sys.exit(1)
\ No newline at end of file
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('log:%s' % ident)
+        try:
+            idle = time.time()
+            while time.time() - idle < 50.0:
+                for line in client.lrange('log:%s' % ident, offset, -1):
+                    if line == EOF:
+                        if sse:
+                            yield 'event: eof\ndata:\n\n'
+                        return
+
+                    if sse:
+                        yield 'id: %s/%d\n%s\n\n' % (ident, offset, '\n'.join('data: %s' % chunk for chunk in line.split('\n')))
+                    else:
+                        yield '%s\n' % line
+
+                    idle = time.time()
+                    offset += 1
+
+                pubsub.get_message(timeout=max(0.0, 50.0 - (time.time() - idle)))
+
+        finally:
+            pubsub.close()
+
+    mimetype = 'text/event-stream' if sse else 'text/plain'
+    return Response(_stream(offset), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Build-Id': ident})
+
+
+@web.route('/', methods=['POST'], defaults={'capabilities': None})
+@web.route('/<capabilities>', methods=['POST'])
+def _git_hook(capabilities):
+
+    logger.info('HTTP -> POST /')
+
+    #
+    # - if we have no build slaves, fast-fail on a 304
+    #
+    if not slaves:
+        return '', 304
+
+    #
+    # - we want the hook to be signed
+    # - fail on a HTTP 403 if not
+    #
+    if not 'X-Hub-Signature' in request.headers:
+        return '', 403
+
+    #
+    # - compute the HMAC and compare (use our pod token as the key)
+    # - fail on a 403 if mismatch
+    #
+    with metrics.timed('hook_hmac_seconds'):
+        digest = 'sha1=' + hmac.new(os.environ['token'], request.data, hashlib.sha1).hexdigest()
+
+    if digest != request.headers['X-Hub-Signature']:
+        return '', 403
+
+    #
+    # - retrieve the branch
+    #
+    logger.debug('git payload -> %s' % request.data)
+    js = json.loads(request.data)
+    branch = js['ref'].split('/')[-1]
+
+    #
+    # - look the slave clusters offering the requested capabilities up (any cluster if none specified)
+    # - if we couldn't find a match abort on a 304
+    #
+    matching = _match(capabilities)
+    if not matching:
+        logger.info('unable to find a slave (capabilities -> %s)' % capabilities)
+        return '', 304
+
+    #
+    # - pick the least loaded candidate and hash the repository to send it to a specific queue
+    # - we do this to splay out the traffic amongst our slaves while retaining stickiness
+    #
+    cfg = js['repository']
+    path = cfg['full_name']
+    key = '%s:%s' % (branch, path)
+    cluster, qid = _dispatch(key, path, matching)
+    build = \
+        {
+            'key':    key,
+            'branch': branch,
+            'lane':   _lane(branch, path),
+            'queued': time.time()
+        }
+
+    #
+    # - if requested cancel whatever build is in progress for that key (it is building an older commit)
+    # - do it before queueing ours : an idle slave could otherwise claim it first and record its id under
+    #   running:<key>, in which case we would cancel the new build instead of the stale one
+    #
+    if supersede:
+        with metrics.timed('hook_redis_seconds', op='cancel'):
+            cancelled = cancel(keys=['running:%s' % key, 'cancel:%s' % key])
+
+        if cancelled:
+            _slack(':rocket: cancelling the build in progress for *%s* (superseded)' % key)
+
+    #
+    # - update the git push data and queue the build in one go
+    #
+    if keep:
+        client.set('raw:%s' % key, request.data)
+
+    outcome = _enqueue(key, cluster, qid, build, payload=_project(js))
+    _slack(':rocket: git push for *%s* (%s), keyed @ _%s_%s' % (key, branch, cluster, '' if outcome == 'queued' else ' (%s)' % outcome))
+    return '', 200
+
+
+@web.route('/build/<branch>/<path:path>', methods=['POST'])
+def _build(branch, path):
+
+    logger.info('HTTP -> POST /build/%s/%s' % (branch, path))
+
+    #
+    # - if we have no build slaves, fast-fail on a 304
+    #
+    if not slaves:
+        return '', 304
+
+    #
+    # - look the specified repository up
+    # - fail on a 404 if not found
+    #
+    key = '%s:%s' % (branch, path)
+    pipe = client.pipeline()
+    pipe.exists('git:%s' % key)
+    pipe.get('slave:%s' % key)
+    with metrics.timed('hook_redis_seconds', op='lookup'):
+        found, cluster = pipe.execute()
+
+    if not found:
+        return '', 404
+
+    #
+    # - retrieve the slave cluster this repository was last keyed to
+    #
+    assert cluster is not None, 'slave:%s not found in redis (bug ?)' % key
+    if cluster not in slaves:
+        return '', 304
+
+    qid = _shard(path, slaves[cluster])
+
+    #
+    # - simply push they key to the appropriate queue (unless already pending)
+    #
+    reset = 'X-Reset' in request.headers and request.headers['X-Reset'] == 'true'
+    build = \
+        {
+            'key': key,
+            'branch': branch,
+            'lane': _lane(branch, path, request.headers.get('X-Priority')),
+            'reset': reset,
+            'queued': time.time()
+        }
+
+    outcome = _enqueue(key, cluster, qid, build)
+    _slack(':rocket: HTTP request for *%s* (%s), keyed @ _%s_%s' % (key, branch, cluster, '' if outcome == 'queued' else ' (%s)' % outcome))
+    return '', 200
+
+
+@web.route('/cancel/<branch>/<path:path>', methods=['POST'])
+def _cancel(branch, path):
+
+    logger.info('HTTP -> POST /cancel/%s/%s' % (branch, path))
+
+    #
+    # - flag the build in progress for that key, the slave will kill whatever it is running and skip the rest
+    # - fail on a 404 if nothing is running
+    #
+    key = '%s:%s' % (branch, path)
+    with metrics.timed('hook_redis_seconds', op='cancel'):
+        cancelled = cancel(keys=['running:%s' % key, 'cancel:%s' % key])
+
+    if not cancelled:
+        return '', 404
+
+    _slack(':rocket: HTTP request to cancel the build in progress for *%s*' % key)
+    return '', 200
@@ -0,0 +1,153 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import time
+
+from contextlib import contextmanager
+from ochopod.core.fsm import diagnostic
+from threading import Lock, Thread
+
+#: our ochopod logger
+logger = logging.getLogger('ochopod')
+
+#: default histogram buckets (in seconds)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+#: histogram buckets for the time builds spend in the queues (in seconds)
+WAITS = [1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0]
+
+
+class Metrics(object):
+
+    """
+    Prometheus-style counters & histograms. Samples are accumulated in memory and periodically flushed into a
+    redis hash (one field per sample) using HINCRBYFLOAT. This way all the processes (e.g gunicorn workers)
+    feeding the same hash add up and any of them can render the totals. Histograms use the default buckets unless
+    declared with their own (every process feeding a histogram must declare it the same way).
+
+    This module is shared by the hook & slave images (keep both copies identical).
+    """
+
+    def __init__(self, client, key, every=5.0):
+
+        self.client = client
+        self.families = {}
+        self.key = key
+        self.lock = Lock()
+        self.pending = {}
+
+        def _spin():
+            while 1:
+                time.sleep(every)
+                self.flush()
+
+        thread = Thread(target=_spin)
+        thread.daemon = True
+        thread.start()
+
+    def declare(self, name, kind, help, buckets=None):
+
+        self.families[name] = (kind, help, buckets or BUCKETS)
+
+    def inc(self, name, value=1.0, **labels):
+
+        sample = _sample(name, labels)
+        with self.lock:
+            self.pending[sample] = self.pending.get(sample, 0.0) + value
+
+    def observe(self, name, seconds, **labels):
+
+        #
+        # - buckets are cumulative, e.g bump all the ones whose upper bound is >= what we observed
+        # - touch the other ones as well so that all the buckets are always rendered
+        #
+        buckets = self.families[name][2] if name in self.families else BUCKETS
+        with self.lock:
+            for bound in buckets + ['+Inf']:
+                sample = _sample('%s_bucket' % name, dict(labels, le=bound))
+                self.pending[sample] = self.pending.get(sample, 0.0) + (1.0 if bound == '+Inf' or seconds <= bound else 0.0)
+
+            for suffix, value in [('sum', seconds), ('count', 1.0)]:
+                sample = _sample('%s_%s' % (name, suffix), labels)
+                self.pending[sample] = self.pending.get(sample, 0.0) + value
+
+    @contextmanager
+    def timed(self, name, **labels):
+
+        tick = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - tick, **labels)
+
+    def flush(self):
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        if not pending:
+            return
+
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for sample, value in pending.items():
+                pipe.hincrbyfloat(self.key, sample, value)
+            pipe.execute()
+
+        except Exception as failure:
+
+            logger.warning('unable to flush metrics (%s)' % diagnostic(failure))
+
+    def render(self, gauges=None):
+
+        #
+        # - read the totals back from redis
+        # - group the samples per family (histograms use several suffixes) and output them using the text
+        #   exposition format
+        # - skip any bucket the histogram does not declare (e.g left over in redis after its buckets changed)
+        # - append any extra gauge sample passed by the caller
+        #
+        samples = self.client.hgetall(self.key)
+        samples.update({_sample(name, labels): value for name, labels, value in gauges or []})
+        lines = []
+        for name in sorted(self.families):
+            kind, help, buckets = self.families[name]
+            bounds = ['le="%s"' % bound for bound in buckets + ['+Inf']]
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+            for sample in sorted(samples):
+                base = sample.split('{')[0]
+                if base == '%s_bucket' % name and not any(bound in sample for bound in bounds):
+                    continue
+
+                if base == name or (kind == 'histogram' and base in ['%s_%s' % (name, suffix) for suffix in ['bucket', 'sum', 'count']]):
+                    lines.append('%s %s' % (sample, _format(samples[sample])))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels):
+
+    if not labels:
+        return name
+
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (key, labels[key]) for key in sorted(labels)))
+
+
+def _format(value):
+
+    value = float(value)
+    return '%d' % value if value.is_integer() else '%.6f' % value
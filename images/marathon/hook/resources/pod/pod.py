@@ -17,10 +17,13 @@
 import json
 import logging
 import os
+import re
+import requests
 import string
 import time
 
 from ochopod.bindings.generic.marathon import Pod
+from ochopod.core.fsm import diagnostic
 from ochopod.core.tools import Shell
 from ochopod.models.piped import Actor as Piped
 from ochopod.models.reactive import Actor as Reactive
@@ -47,13 +50,15 @@ if __name__ == '__main__':
     class Strategy(Piped):
 
         cwd = '/opt/hook'
-        
+
         check_every = 60.0
 
         pid = None
 
         since = 0.0
 
+        last = None
+
         def sanity_check(self, pid):
 
             #
@@ -66,13 +71,65 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
-
-            return \
+            metrics = \
                 {
                     'token': token,
                     'uptime': '%.2f hours (pid %s)' % (lapse, pid)
                 }
 
+            #
+            # - scrape our own /metrics endpoint : the counters are aggregated across all the hooks, what we report is
+            #   therefore cluster-wide (e.g every hook pod reports the same numbers)
+            # - sum the samples we care about across their labels (the histogram buckets are summed per bound)
+            # - skip the GET /metrics samples (e.g our own scrapes)
+            # - leave the long-polls out of the latency (they would mostly report how long they waited)
+            # - derive the request rate & latency from the difference with what we got upon the last check
+            #
+            try:
+                reply = requests.get('http://localhost:5000/metrics', timeout=5.0)
+                assert reply.status_code == 200, 'HTTP %d' % reply.status_code
+                totals = {}
+                buckets = {}
+                for line in reply.text.split('\n'):
+                    if not line or line.startswith('#') or 'route="GET /metrics"' in line:
+                        continue
+
+                    sample, value = line.rsplit(' ', 1)
+                    name = sample.split('{')[0]
+                    if name.startswith('hook_request_seconds') and '(long-poll)"' in sample:
+                        continue
+
+                    totals[name] = totals.get(name, 0.0) + float(value)
+                    if name == 'hook_request_seconds_bucket':
+                        bound = re.search(r'le="([^"]+)"', sample).group(1)
+                        buckets[bound] = buckets.get(bound, 0.0) + float(value)
+
+                snapshot = now, totals, buckets
+                if self.last:
+                    then, previous, before = self.last
+                    requested = totals.get('hook_requests_total', 0.0) - previous.get('hook_requests_total', 0.0)
+                    count = totals.get('hook_request_seconds_count', 0.0) - previous.get('hook_request_seconds_count', 0.0)
+                    spent = totals.get('hook_request_seconds_sum', 0.0) - previous.get('hook_request_seconds_sum', 0.0)
+                    bounds = sorted(buckets, key=lambda bound: float(bound))
+                    p95 = next((bound for bound in bounds if buckets[bound] - before.get(bound, 0.0) >= 0.95 * count), '+Inf')
+                    metrics['all hooks'] = \
+                        {
+                            'requests per minute': round(60.0 * requested / (now - then), 1),
+                            'latency': '%.1f ms' % (1000.0 * spent / count) if count else None,
+                            'p95': '< %s s' % p95 if count else None
+                        }
+
+                metrics.setdefault('all hooks', {})
+                metrics['all hooks']['queued'] = int(totals.get('hook_queue_depth', 0))
+                metrics['all hooks']['deferred'] = int(totals.get('hook_deferred_builds', 0))
+                self.last = snapshot
+
+            except Exception as failure:
+
+                logger.warning('unable to scrape our metrics (%s)' % diagnostic(failure))
+
+            return metrics
+
         def can_configure(self, cluster):
 
             assert cluster.grep('redis', 6379), '1 redis required'
@@ -88,7 +145,12 @@ if __name__ == '__main__':
             keys = set(unrolled)
             tally = {key: unrolled.count(key) for key in keys}
 
-            return 'python hook.py', \
+            #
+            # - run the flask endpoint on TCP 5000 via gunicorn using gevent workers
+            # - the # of workers can be set in the pod settings (default to 4)
+            #
+            workers = int(settings['workers']) if 'workers' in settings else 4
+            return 'gunicorn -k gevent -w %d -b 0.0.0.0:5000 hook:web' % workers, \
                    {
                        'token': token,
                        'redis': cluster.grep('redis', 6379),
@@ -0,0 +1,62 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import hashlib
+
+from argparse import ArgumentParser
+
+
+def _shard(path, modulo):
+
+    #
+    # - rendezvous hashing, same as _shard() in resources/hook.py
+    #
+    return max(range(modulo), key=lambda index: hashlib.md5('%s#%d' % (path, index)).digest())
+
+
+def _modulo(path, modulo):
+
+    #
+    # - plain modulo over a md5 digest of the repository (e.g what a naive stable hash would do)
+    #
+    return int(hashlib.md5(path).hexdigest(), 16) % modulo
+
+
+if __name__ == '__main__':
+
+    #
+    # - simulate how many repositories are re-assigned to another queue when going from N to N+1 slaves, using our
+    #   rendezvous hashing versus a plain modulo
+    # - also report how evenly the repositories are spread over the N+1 queues
+    # - the repository names are synthetic (owner-<i>/repo-<j>, 100 repositories per owner)
+    #
+    parser = ArgumentParser(description='key movement & balance simulation for the slave queue sharding')
+    parser.add_argument('-r', '--repositories', type=int, default=10000, help='# of repositories')
+    parser.add_argument('-s', '--slaves', type=str, default='4,8', help='comma separated # of slaves N to grow by one')
+    args = parser.parse_args()
+
+    paths = ['owner-%d/repo-%d' % (n / 100, n) for n in range(args.repositories)]
+    for slaves in [int(token) for token in args.slaves.split(',')]:
+        moved = {}
+        for name, pick in [('rendezvous', _shard), ('modulo', _modulo)]:
+            moved[name] = sum(1 for path in paths if pick(path, slaves) != pick(path, slaves + 1))
+
+        spread = [0] * (slaves + 1)
+        for path in paths:
+            spread[_shard(path, slaves + 1)] += 1
+
+        print '%d -> %d slaves : %.1f%% moved (plain modulo: %.1f%%), spread over %d: %s' % \
+            (slaves, slaves + 1, 100.0 * moved['rendezvous'] / len(paths), 100.0 * moved['modulo'] / len(paths), slaves + 1, ' / '.join(str(count) for count in spread))
@@ -16,6 +16,7 @@ import time
 
 from ochopod.bindings.generic.marathon import Pod
 from ochopod.core.tools import Shell
+from ochopod.core.utils import shell
 from ochopod.models.piped import Actor as Piped
 
 logger = logging.getLogger('ochopod')
@@ -45,12 +46,32 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
-
-            return \
+            metrics = \
                 {
                     'uptime': '%.2f hours (pid %s)' % (lapse, pid)
                 }
 
+            #
+            # - INFO is cheap (no key is scanned), parse its key:value lines
+            # - the keyspace section has one db<n>:keys=<n>,expires=<n>,... line per database
+            #
+            code, lines = shell('redis-cli info')
+            if code == 0:
+                info = dict(line.strip().split(':', 1) for line in lines if ':' in line and not line.startswith('#'))
+                keys = [dict(pair.split('=') for pair in info[db].split(',')) for db in info if db.startswith('db')]
+                metrics['redis'] = \
+                    {
+                        'memory': '%s (peak %s)' % (info['used_memory_human'], info['used_memory_peak_human']),
+                        'fragmentation': float(info['mem_fragmentation_ratio']),
+                        'keys': sum(int(db['keys']) for db in keys),
+                        'expiring': sum(int(db['expires']) for db in keys),
+                        'clients': int(info['connected_clients']),
+                        'ops/s': int(info['instantaneous_ops_per_sec']),
+                        'evicted': int(info['evicted_keys'])
+                    }
+
+            return metrics
+
         def configure(self, _):
 
             return '/usr/local/bin/redis-server redis-server.conf', {}
@@ -45,6 +45,7 @@ if __name__ == '__main__':
         # - enable CLI logging
         #
         blocked = {}
+        counters = {'runs': 0, 'failed': 0}
         env = os.environ
         hints = json.loads(env['ochopod'])
         ochopod.enable_cli_log(debug=hints['debug'] == 'true')
@@ -66,6 +67,25 @@ if __name__ == '__main__':
 
             return '', 200
 
+        @web.route('/stats', methods=['GET'])
+        def _stats():
+
+            #
+            # - report how many jobs are running (e.g blocked on their callback) plus our totals
+            # - this is polled by our pod sanity check
+            #
+            js = \
+                {
+                    'running': len(blocked),
+                    'runs': counters['runs'],
+                    'failed': counters['failed']
+                }
+
+            return json.dumps(js), 200, \
+                {
+                    'Content-Type': 'application/json; charset=utf-8'
+                }
+
         @web.route('/run/<scripts>', methods=['POST'])
         def _from_curl(scripts):
 
@@ -166,9 +186,12 @@ if __name__ == '__main__':
 
                 #
                 # - make sure to cleanup our temporary directory
+                # - update our totals
                 #
                 del blocked[token]
                 shutil.rmtree(tmp)
+                counters['runs'] += 1
+                counters['failed'] += 0 if ok else 1
 
             if raw:
 
@@ -23,6 +23,7 @@ import time
 
 from ochopod.api import Tool
 from ochopod.bindings.generic.marathon import Pod
+from ochopod.core.fsm import diagnostic
 from ochopod.core.tools import Shell
 from ochopod.core.utils import shell
 from ochopod.models.piped import Actor as Piped
@@ -125,13 +126,26 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
-
-            return \
+            metrics = \
                 {
                     'token': token,
                     'uptime': '%.2f hours (pid %s)' % (lapse, pid)
                 }
 
+            #
+            # - ask the servo how many jobs it is running (and how many ran so far)
+            #
+            try:
+                reply = requests.get('http://localhost:5000/stats', timeout=5.0)
+                assert reply.status_code == 200, 'HTTP %d' % reply.status_code
+                metrics['jobs'] = json.loads(reply.text)
+
+            except Exception as failure:
+
+                logger.warning('unable to query the servo (%s)' % diagnostic(failure))
+
+            return metrics
+
         def can_configure(self, cluster):
 
             assert len(cluster.dependencies['portal']) == 1, 'need 1 portal'
@@ -14,10 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
+import requests
 import time
 
 from ochopod.bindings.generic.marathon import Pod
+from ochopod.core.fsm import diagnostic
 from ochopod.core.tools import Shell
 from ochopod.models.piped import Actor as Piped
 
@@ -50,12 +53,25 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
-
-            return \
+            metrics = \
                 {
                     'uptime': '%.2f hours (pid %s)' % (lapse, pid)
                 }
 
+            #
+            # - ask the relay how full its buffer is and how many messages it posted or dropped
+            #
+            try:
+                reply = requests.get('http://localhost:9000/stats', timeout=5.0)
+                assert reply.status_code == 200, 'HTTP %d' % reply.status_code
+                metrics['relay'] = json.loads(reply.text)
+
+            except Exception as failure:
+
+                logger.warning('unable to query the relay (%s)' % diagnostic(failure))
+
+            return metrics
+
         def configure(self, cluster):
 
             #
@@ -49,7 +49,11 @@ class _Accumulator(FSM):
     def __init__(self):
         super(_Accumulator, self).__init__()
 
+        self.accepted = 0
+        self.failed = 0
         self.pending = deque()
+        self.posted = 0
+        self.rejected = 0
 
     def initial(self, data):
 
@@ -84,7 +88,12 @@ class _Accumulator(FSM):
                     'attachments':  json.dumps([js])
                 }
 
-            requests.post('https://slack.com/api/chat.postMessage', data=data)
+            reply = requests.post('https://slack.com/api/chat.postMessage', data=data)
+            if reply.status_code < 300:
+                self.posted += len(self.pending)
+            else:
+                self.failed += len(self.pending)
+
             self.pending.clear()
 
         return 'spin', data, 1.0
@@ -94,11 +103,30 @@ class _Accumulator(FSM):
         if 'line' in msg:
 
             #
-            # - buffer
-            # - push back if > 100
+            # - push back if we already buffer 100 lines (the line is then dropped)
+            # - buffer otherwise
             #
+            if len(self.pending) >= 100:
+                self.rejected += 1
+                return False
+
             self.pending.append(msg['line'])
-            return len(self.pending) < 100
+            self.accepted += 1
+            return True
+
+        elif 'stats' in msg:
+
+            #
+            # - report our buffer fill & totals
+            #
+            return \
+                {
+                    'buffered': '%d/100' % len(self.pending),
+                    'accepted': self.accepted,
+                    'rejected': self.rejected,
+                    'posted': self.posted,
+                    'failed': self.failed
+                }
 
         else:
             super(_Accumulator, self).specialized(msg)
@@ -120,4 +148,16 @@ class _Handler(object):
             raise falcon.HTTPError('buffer at capacity', code='304')
 
 
+class _Stats(object):
+
+    def on_get(self, req, resp):
+
+        #
+        # - polled by our pod sanity check
+        #
+        resp.body = json.dumps(_Handler.accumulator.ask({'stats': 1}))
+        resp.content_type = 'application/json'
+
+
 endpoint.add_route('/', _Handler())
+endpoint.add_route('/stats', _Stats())
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import sys
+import time
+
+from argparse import ArgumentParser
+from Queue import Queue, Empty
+from subprocess import Popen
+from threading import Thread
+
+#: fake build : wait on "the network" for a while then burn some CPU (in a sub-process, like a real build)
+WORKLOAD = """
+import os
+import time
+time.sleep(%f)
+while sum(os.times()[:2]) < %f:
+    pass
+"""
+
+
+def _throughput(workers, builds, sleep, cpu):
+
+    #
+    # - queue B fake builds and drain them using N worker threads (e.g like the slave workers popping their queue)
+    # - return the # of builds per minute
+    #
+    pending = Queue()
+    for n in range(builds):
+        pending.put(n)
+
+    def _work():
+        while 1:
+            try:
+                pending.get_nowait()
+            except Empty:
+                return
+
+            Popen([sys.executable, '-c', WORKLOAD % (sleep, cpu)]).wait()
+
+    threads = [Thread(target=_work) for _ in range(workers)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return 60.0 * builds / (time.time() - started)
+
+
+if __name__ == '__main__':
+
+    #
+    # - measure how many builds per minute a slave would go through depending on its # of concurrent workers, using
+    #   a local fake workload (no redis, git or docker involved)
+    #
+    parser = ArgumentParser(description='throughput benchmark for concurrent slave workers')
+    parser.add_argument('-w', '--workers', type=str, default='1,2,4,8', help='comma separated # of workers to try')
+    parser.add_argument('-b', '--builds', type=int, default=32, help='# of builds to run for each try')
+    parser.add_argument('-s', '--sleep', type=float, default=0.4, help='seconds each build spends waiting')
+    parser.add_argument('-c', '--cpu', type=float, default=0.2, help='seconds of CPU each build burns')
+    args = parser.parse_args()
+
+    print '%-8s %12s' % ('workers', 'builds/min')
+    for workers in [int(token) for token in args.workers.split(',')]:
+        print '%-8d %12.1f' % (workers, _throughput(workers, args.builds, args.sleep, args.cpu))
@@ -0,0 +1,216 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import shutil
+import time
+
+from glob import glob
+from ochopod.core.fsm import diagnostic
+from ochopod.core.utils import shell
+from os import path
+from threading import Lock
+
+#: our ochopod logger
+logger = logging.getLogger('ochopod')
+
+#: where the cache statistics are dumped (read by the pod sanity check)
+STATS = '/opt/slave/cache.json'
+
+
+class Cache(object):
+
+    """
+    Disk budgeted LRU cache of the slave directories : the bare repository mirrors (/tmp/<repo>.git) and the branch
+    workspaces borrowing their objects (/tmp/<repo>-<branch>). Each directory is guarded by its own lock which is
+    held while in use. Directories in use are never evicted and a mirror is only evicted together with its
+    workspaces. The output spooled by the last build of a workspace (<spool>/<repo>-<branch>) is accounted for and
+    evicted together with it.
+    """
+
+    def __init__(self, root='/tmp', budget=0, spool=None):
+
+        self.budget = budget * 1024 * 1024
+        self.evicting = Lock()
+        self.evicted = 0
+        self.guard = Lock()
+        self.hits = 0
+        self.locks = {}
+        self.misses = 0
+        self.mirrors = {}
+        self.root = root
+        self.sizes = {}
+        self.spool = spool
+        self.used = {}
+
+        #
+        # - our directories may outlive us (e.g if the slave restarts), index what is already there
+        # - a workspace points to its mirror via its git alternates
+        #
+        for mirror in glob(path.join(root, '*.git')):
+            self._index(mirror, None, path.getmtime(mirror))
+
+        for alternates in glob(path.join(root, '*', '*', '.git', 'objects', 'info', 'alternates')):
+            with open(alternates, 'r') as f:
+                mirror = path.dirname(f.read().strip())
+
+            workspace = path.dirname(path.dirname(path.dirname(path.dirname(path.dirname(alternates)))))
+            self._index(workspace, mirror, path.getmtime(workspace))
+
+        #
+        # - drop any spooled output whose workspace is gone
+        #
+        if spool:
+            for directory in glob(path.join(spool, '*')):
+                if path.join(root, path.basename(directory)) not in self.mirrors:
+                    shutil.rmtree(directory, ignore_errors=True)
+
+        self.update(*self.used.keys())
+        self._dump()
+
+    def lock(self, directory):
+
+        with self.guard:
+            if directory not in self.locks:
+                self.locks[directory] = Lock()
+            return self.locks[directory]
+
+    def touch(self, workspace, mirror, hit):
+
+        #
+        # - a build is about to use this workspace (and its mirror), it must hold the workspace lock
+        #
+        with self.guard:
+            self.hits += 1 if hit else 0
+            self.misses += 0 if hit else 1
+
+        self._index(workspace, mirror, time.time())
+        self._index(mirror, None, time.time())
+
+    def update(self, *directories):
+
+        #
+        # - re-compute the size of the specified directories (e.g after a build)
+        # - a workspace does not account for the objects it borrows from its mirror
+        # - a workspace accounts for its spooled output
+        #
+        for directory in directories:
+            size = 0
+            for entry in [directory, self._spooled(directory)]:
+                if entry and path.exists(entry):
+                    code, lines = shell('du -sk %s' % entry)
+                    if code == 0 and lines:
+                        size += int(lines[0].split()[0]) * 1024
+
+            with self.guard:
+                if directory in self.sizes:
+                    self.sizes[directory] = size
+
+    def evict(self):
+
+        #
+        # - only one thread at a time goes through this
+        # - walk our directories least recently used first until we are within budget
+        # - skip anything locked (e.g in use), evicting a mirror requires locking all its workspaces
+        # - dump our statistics once done
+        #
+        if not self.evicting.acquire(False):
+            return
+
+        try:
+            with self.guard:
+                candidates = sorted(self.used, key=lambda directory: self.used[directory])
+
+            for directory in candidates:
+                if not self.budget or self.stats()['bytes'] <= self.budget:
+                    break
+
+                if directory not in self.used:
+                    continue
+
+                with self.guard:
+                    group = [workspace for workspace, mirror in self.mirrors.items() if mirror == directory] + [directory]
+
+                locks = [self.lock(entry) for entry in group]
+                held = [lock for lock in locks if lock.acquire(False)]
+                try:
+                    if len(held) < len(locks):
+                        continue
+
+                    for entry in group:
+                        spooled = self._spooled(entry)
+                        self._forget(entry)
+                        shutil.rmtree(entry, ignore_errors=True)
+                        if spooled:
+                            shutil.rmtree(spooled, ignore_errors=True)
+                        logger.info('evicted %s from the cache' % entry)
+
+                finally:
+                    for lock in held:
+                        lock.release()
+
+        except Exception as failure:
+
+            logger.warning('unable to evict (%s)' % diagnostic(failure))
+
+        finally:
+            self.evicting.release()
+            self._dump()
+
+    def stats(self):
+
+        with self.guard:
+            return \
+                {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evicted': self.evicted,
+                    'directories': len(self.used),
+                    'bytes': sum(self.sizes.values()),
+                    'budget': self.budget
+                }
+
+    def _index(self, directory, mirror, used):
+
+        with self.guard:
+            self.used[directory] = used
+            self.sizes.setdefault(directory, 0)
+            if mirror:
+                self.mirrors[directory] = mirror
+
+    def _spooled(self, directory):
+
+        with self.guard:
+            return path.join(self.spool, path.basename(directory)) if self.spool and directory in self.mirrors else None
+
+    def _forget(self, directory):
+
+        with self.guard:
+            self.evicted += 1
+            del self.used[directory]
+            del self.sizes[directory]
+            self.mirrors.pop(directory, None)
+
+    def _dump(self):
+
+        try:
+            with open(STATS, 'w') as f:
+                f.write(json.dumps(self.stats()))
+
+        except IOError as failure:
+
+            logger.warning('unable to dump the cache statistics (%s)' % diagnostic(failure))
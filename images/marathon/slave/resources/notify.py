@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import logging
+import requests
+
+from ochopod.core.fsm import diagnostic
+from Queue import Queue, Empty, Full
+from threading import Thread
+
+#: our ochopod logger
+logger = logging.getLogger('ochopod')
+
+
+class Notifier(object):
+
+    """
+    Asynchronous notifier forwarding lines to the slack relay. Lines are buffered in a bounded in-memory queue
+    and posted by a background thread re-using the same keep-alive connection. Consecutive lines are batched
+    together. Calling the notifier never blocks : lines are simply dropped (and counted) if the queue is full. Lines
+    the relay rejects because it is at capacity are counted as overflow, lines that could not be posted as failed.
+    The optional counted callable is passed each counter update as it happens (e.g to feed metrics).
+
+    This module is shared by the hook & slave images (keep both copies identical).
+    """
+
+    def __init__(self, url, capacity=1024, batch=32, timeout=5.0, counted=None):
+
+        self.batch = batch
+        self.counted = counted
+        self.counts = {'sent': 0, 'dropped': 0, 'overflow': 0, 'failed': 0}
+        self.pending = Queue(capacity)
+        self.session = requests.Session()
+        self.timeout = timeout
+        self.url = url
+
+        thread = Thread(target=self._spin)
+        thread.daemon = True
+        thread.start()
+
+    def __call__(self, line):
+
+        try:
+            self.pending.put_nowait(line)
+
+        except Full:
+            self._count('dropped', 1)
+
+    def stats(self):
+
+        return dict(self.counts, queued=self.pending.qsize())
+
+    def _count(self, outcome, lines):
+
+        self.counts[outcome] += lines
+        if self.counted:
+            try:
+                self.counted(outcome, lines)
+
+            except Exception as failure:
+
+                logger.warning('unable to count notifications (%s)' % diagnostic(failure))
+
+    def _spin(self):
+
+        headers = \
+            {
+                'Content-Type': 'application/json'
+            }
+
+        while 1:
+
+            #
+            # - block until we have something to send
+            # - grab whatever else is queued (up to our batch size)
+            #
+            lines = [self.pending.get()]
+            while len(lines) < self.batch:
+                try:
+                    lines.append(self.pending.get_nowait())
+                except Empty:
+                    break
+
+            #
+            # - the relay buffers each POST as one message, just send the lines in one go
+            # - the relay will reply with a HTTP 304 if at capacity
+            #
+            try:
+                body = u'\n'.join(line if isinstance(line, unicode) else line.decode('utf-8') for line in lines)
+                reply = self.session.post(self.url, data=body.encode('utf-8'), headers=headers, timeout=self.timeout)
+                self._count('sent' if reply.status_code < 300 else 'overflow' if reply.status_code == 304 else 'failed', len(lines))
+
+            except Exception as failure:
+
+                self._count('failed', len(lines))
+                logger.warning('unable to notify (%s)' % diagnostic(failure))
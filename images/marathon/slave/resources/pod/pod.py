@@ -19,11 +19,14 @@ import logging
 import os
 import time
 
+from collections import deque
 from jinja2 import Environment, FileSystemLoader
+from ochopod.api import Tool
 from ochopod.bindings.generic.marathon import Pod
 from ochopod.core.tools import Shell
 from ochopod.models.piped import Actor as Piped
 from ochopod.models.reactive import Actor as Reactive
+from os.path import exists, getsize, join
 
 
 logger = logging.getLogger('ochopod')
@@ -31,6 +34,46 @@ logger = logging.getLogger('ochopod')
 
 if __name__ == '__main__':
 
+    class Output(Tool):
+        """
+        Dedicated tool to retrieve the full output of the shell snippets run during the last build of a given
+        repository & branch (the build log only contains an excerpt). Each snippet is identified by the index of its
+        step and its own index within that step (e.g 1-0 for the first snippet of the second step, 2.1-0 for the first
+        snippet of the second member of a parallel group defined as the third step). The snippets are listed if none
+        is specified.
+
+        CLI usage:
+        $ exec *.slave output paugamo/test master
+        $ exec *.slave output paugamo/test master 1-0 -n 100
+        """
+
+        tag = 'output'
+
+        def define_cmdline_parsing(self, parser):
+
+            parser.add_argument('repo', type=str, nargs=1, help='the repository (e.g paugamo/test)')
+            parser.add_argument('branch', type=str, nargs=1, help='the branch')
+            parser.add_argument('snippet', type=str, nargs='?', help='the snippet (e.g 1-0)')
+            parser.add_argument('-n', '--lines', action='store', dest='lines', type=int, default=0, help='only return the last N lines')
+
+        def body(self, args, cwd):
+
+            #
+            # - the slave spools the output under /opt/slave/spool/<repo>-<branch>/<snippet>.log
+            #
+            spool = join('/opt/slave/spool', '%s-%s' % (args.repo[0].replace('/', '-'), args.branch[0]))
+            assert exists(spool), 'no build output for %s (%s) on this slave' % (args.repo[0], args.branch[0])
+            if not args.snippet:
+                names = sorted(name for name in os.listdir(spool) if name.endswith('.log'))
+                return 0, ['%s (%d bytes)' % (name[:-4], getsize(join(spool, name))) for name in names]
+
+            log = join(spool, '%s.log' % args.snippet)
+            assert exists(log), 'unknown snippet %s' % args.snippet
+            with open(log, 'r') as f:
+                lines = deque(f, maxlen=args.lines) if args.lines else f.readlines()
+
+            return 0, [line.rstrip('\n') for line in lines]
+
     class Model(Reactive):
 
         depends_on = ['slack-relay', 'redis']
@@ -59,8 +102,51 @@ if __name__ == '__main__':
                 self.since = now
 
             lapse = (now - self.since) / 3600.0
+            metrics = {'uptime': '%.2f hours (pid %s)' % (lapse, pid)}
+
+            #
+            # - the slave dumps its cache statistics into /opt/slave/cache.json
+            # - it may not be there yet if the slave just started
+            #
+            try:
+                with open('/opt/slave/cache.json', 'r') as f:
+                    cache = json.loads(f.read())
+
+                metrics['cache'] = \
+                    {
+                        'hits': cache['hits'],
+                        'misses': cache['misses'],
+                        'evicted': cache['evicted'],
+                        'size': '%.2f/%.2f GB' % (cache['bytes'] / 1e9, cache['budget'] / 1e9)
+                    }
+
+            except (IOError, ValueError):
+                pass
+
+            #
+            # - the slave also dumps its queue depth, throughput & notifier counters into /opt/slave/slave.json every
+            #   30 seconds
+            #
+            try:
+                with open('/opt/slave/slave.json', 'r') as f:
+                    stats = json.loads(f.read())
+
+                metrics['builds'] = \
+                    {
+                        'queued': stats['queued'],
+                        'running': '%d/%d' % (stats['running'], stats['workers']),
+                        'per hour': stats['builds'],
+                        'failed': stats['failed'],
+                        'average': '%d seconds' % stats['average']
+                    }
+
+                if 'notifier' in stats:
+                    metrics['notifications'] = stats['notifier']
+
+            except (IOError, ValueError):
+                pass
 
-            return {'uptime': '%.2f hours (pid %s)' % (lapse, pid)}
+            return metrics
 
         def can_configure(self, cluster):
 
@@ -88,13 +174,15 @@ if __name__ == '__main__':
             # - note we use supervisor to socat the unix socket used by the underlying docker daemon
             # - it is bound to TCP 9001 (e.g any curl to localhost:9001 will talk to the docker API)
             # - the index is unique amongst the slave cluster and used to shard builds on specific hosts
+            # - the cluster size is used to look at the other queues when stealing builds
             # - run the slave
             #
             return 'python slave.py', \
                    {
                        'index': cluster.index,
+                       'slaves': cluster.size,
                        'redis': cluster.grep('redis', 6379),
                        'slack': cluster.grep('slack-relay', 9000)
                    }
 
-    Pod().boot(Strategy, model=Model, tools=[Shell])
\ No newline at end of file
+    Pod().boot(Strategy, model=Model, tools=[Output, Shell])
\ No newline at end of file
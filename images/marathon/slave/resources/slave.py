@@ -14,27 +14,560 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
 import json
 import logging
 import ochopod
 import os
+import pipes
 import re
 import redis
-import requests
 import shutil
+import signal
 import sys
 import tempfile
 import time
 import yaml
+import zlib
 
+from cache import Cache
+from collections import deque
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from itertools import count
+from metrics import Metrics, WAITS
+from multiprocessing import cpu_count
+from notify import Notifier
 from ochopod.core.utils import shell
 from ochopod.core.fsm import diagnostic
 from os import path
+from subprocess import Popen, PIPE, STDOUT
+from threading import Event, Lock, Semaphore, Thread
 from yaml import YAMLError
 
 
 logger = logging.getLogger('ochopod')
 
+#: marker terminating the log:<id> list once the build is over
+EOF = '\x00'
+
+#: our priority lanes, highest first (must match the hook)
+LANES = ['high', 'normal', 'low']
+
+#: where the full output of each shell snippet is spooled (one directory per branch/repository)
+SPOOL = '/opt/slave/spool'
+
+#: how much of the output of each shell snippet we spool at most (its tail is kept)
+SPOOLED = 64 * 1024 * 1024
+
+#: where our statistics are periodically dumped (read by the pod sanity check)
+STATS = '/opt/slave/slave.json'
+
+#: how many lines of output we keep in memory at the beginning & end of each shell snippet
+HEAD, TAIL = 50, 150
+
+#: how many lines of live output (debug steps & parallel groups) we stream to log:<id> at most per build
+STREAMED = 100000
+
+#: how long (seconds) running:<key>, tail:<key> and log:<id> outlive a build whose slave stopped refreshing them
+LEASE = 300
+
+
+def _available():
+
+    #
+    # - return how much memory (in MB) is available on the host
+    # - older kernels do not report MemAvailable, approximate it with the free + cached pages
+    #
+    with open('/proc/meminfo', 'r') as f:
+        info = {line.split(':')[0]: int(line.split()[1]) for line in f}
+
+    kb = info['MemAvailable'] if 'MemAvailable' in info else info['MemFree'] + info['Cached']
+    return kb / 1024
+
+
+def _run(script, cwd, env, spool, deadline=None, cancelled=None, failed=None, each=None):
+
+    #
+    # - run the script in its own process group and stream its output line by line into the spool file
+    # - only keep its first & last lines in memory (very long lines are split)
+    # - the spool file is capped : once half the cap is written it is rotated to <spool>.1 (overwriting the
+    #   previous one) and both are merged back once done (e.g we keep between half & all of the cap worth of tail)
+    # - a watchdog kills the whole process group if the deadline passes or if the build is cancelled (SIGTERM
+    #   first, then SIGKILL if still running after a few seconds)
+    # - failed is an optional event set when a sibling in a group of parallel steps fails, in which case we are
+    #   killed as well (and reported as cancelled)
+    # - the watchdog runs until we stop reading : any background process started by the script (e.g server &)
+    #   holds our pipe open and is part of the process group, even once bash itself exited
+    # - each is an optional callable passed each line of output as soon as it is read (it should return quickly)
+    # - return its exit code, an excerpt of its output and why it was killed (if it was)
+    #
+    first = []
+    last = deque(maxlen=TAIL)
+    total = 0
+    killed = []
+    drained = Event()
+    pid = Popen(['/bin/bash', script], cwd=cwd, env=env, stdout=PIPE, stderr=STDOUT, bufsize=-1, preexec_fn=os.setsid)
+
+    def _watch():
+        while not drained.is_set():
+            stopped = any(event and event.is_set() for event in [cancelled, failed])
+            reason = 'timeout' if deadline and time.time() > deadline else 'cancelled' if stopped else None
+            if reason:
+                killed.append(reason)
+                for sig, grace in [(signal.SIGTERM, 5.0), (signal.SIGKILL, 0.0)]:
+                    try:
+                        os.killpg(pid.pid, sig)
+                    except OSError:
+                        return
+
+                    if drained.wait(grace):
+                        return
+
+                return
+
+            drained.wait(0.25)
+
+    if deadline or cancelled or failed:
+        watchdog = Thread(target=_watch)
+        watchdog.daemon = True
+        watchdog.start()
+
+    size = 0
+    written = 0
+    rotated = '%s.1' % spool
+    f = open(spool, 'w')
+    try:
+        for line in iter(lambda: pid.stdout.readline(4096), ''):
+            if written >= SPOOLED / 2:
+                f.close()
+                os.rename(spool, rotated)
+                f = open(spool, 'w')
+                written = 0
+
+            f.write(line)
+            size += len(line)
+            written += len(line)
+            total += 1
+            if each:
+                each(line.rstrip('\n'))
+
+            if len(first) < HEAD:
+                first.append(line.rstrip('\n'))
+            else:
+                last.append(line.rstrip('\n'))
+    finally:
+        f.close()
+        drained.set()
+
+    if path.exists(rotated):
+        merged = '%s.tmp' % spool
+        with open(merged, 'w') as f:
+            f.write('... %d bytes skipped ...\n' % (size - path.getsize(rotated) - written))
+            for part in [rotated, spool]:
+                with open(part, 'r') as chunk:
+                    shutil.copyfileobj(chunk, f)
+
+        os.rename(merged, spool)
+        os.remove(rotated)
+
+    code = pid.wait()
+    skipped = total - len(first) - len(last)
+    return code, first + (['... %d lines skipped ...' % skipped] if skipped else []) + list(last), killed[0] if killed else None
+
+
+def _git(command, cwd=None, deadline=None, cancelled=None):
+
+    #
+    # - run a (potentially long) git command through _run() so that the build deadline & cancellation apply
+    # - its output is spooled to a temporary file we drop once done
+    # - fail the build if it was killed
+    # - return its exit code
+    #
+    fd, script = tempfile.mkstemp(suffix='.sh')
+    with os.fdopen(fd, 'w') as f:
+        f.write(command)
+
+    try:
+        code, _, killed = _run(script, cwd, dict(os.environ), '%s.log' % script, deadline=deadline, cancelled=cancelled)
+        assert not killed, 'build %s (%s)' % ('timed out' if killed == 'timeout' else 'cancelled', ' '.join(command.split()[:2]))
+        return code
+
+    finally:
+        for leftover in [script, '%s.log' % script]:
+            if path.exists(leftover):
+                os.remove(leftover)
+
+
+def _fetch(mirror, branch, sha, deadline=None, cancelled=None):
+
+    #
+    # - make sure the specified commit is in a bare mirror
+    # - don't hit the network if we have it already (e.g prefetched)
+    # - otherwise fetch the branch it was pushed to (and the commit itself if the branch moved on already)
+    # - the fetches are killed if the build deadline passes or if the build is cancelled
+    # - return 1 if we had to fetch
+    #
+    code, _ = shell('git cat-file -e %s^{commit}' % sha, cwd=mirror)
+    if code == 0:
+        return 0
+
+    _git('git fetch origin +refs/heads/%s:refs/heads/%s' % (branch, branch), cwd=mirror, deadline=deadline, cancelled=cancelled)
+    code, _ = shell('git cat-file -e %s^{commit}' % sha, cwd=mirror)
+    if code != 0:
+        _git('git fetch origin %s' % sha, cwd=mirror, deadline=deadline, cancelled=cancelled)
+
+    return 1
+
+
+@contextmanager
+def _locked(lock, deadline=None, cancelled=None):
+
+    #
+    # - hold a lock, polling for it so that we can give up if the build deadline passes or if the build is cancelled
+    #   meanwhile (e.g while a prefetch holds the mirror)
+    #
+    while not lock.acquire(False):
+        assert not deadline or time.time() < deadline, 'build timed out (waiting on the mirror)'
+        assert not cancelled or not cancelled.is_set(), 'build cancelled (waiting on the mirror)'
+        time.sleep(0.25)
+
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def _capped(snippet):
+
+    capped = snippet if len(snippet) < 32 else '%s...' % snippet[:64]
+    return capped.replace('\n', ' ')
+
+
+def _digest(blk, cwd, commit):
+
+    #
+    # - hash the files matching the step inputs (globs relative to the step directory, * also matching /)
+    #   together with its cache key, directory, environment variables & shell snippets
+    # - only look at what is committed (e.g not at whatever previous builds left in the workspace) : git ls-tree
+    #   gives us the blob id of each file for free (listed relative to the step directory when run from it)
+    #
+    sha = hashlib.sha1()
+    patterns = blk['inputs'] if 'inputs' in blk else []
+    for key in ['cache_key', 'cwd', 'env', 'shell']:
+        sha.update('%s=%s\0' % (key, json.dumps(blk[key] if key in blk else None, sort_keys=True)))
+
+    if patterns:
+        code, lines = shell('git -c core.quotepath=off ls-tree -r %s' % commit, cwd=cwd)
+        assert code == 0, 'unable to list the inputs of %s' % blk['step']
+        for line in lines:
+            meta, relative = line.split('\t', 1)
+            if any(fnmatch(relative, pattern) for pattern in patterns):
+                sha.update('%s %s\0' % (relative, meta.split()[2]))
+
+    return sha.hexdigest()
+
+
+def _parses(snippet):
+
+    #
+    # - check the syntax of a shell snippet without running it (bash -n)
+    #
+    pid = Popen(['/bin/bash', '-n'], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+    pid.communicate(snippet)
+    return pid.returncode == 0
+
+
+def _batch(blk, ok, cwd, var, tmp, spool, abridged, emit, failed=None, deadline=None, cancelled=None, live=None):
+
+    #
+    # - run all the shell snippets of a step in one bash session (each snippet still runs in its own sub-shell)
+    # - the session tracks $OK by itself and skips whatever snippet it should
+    # - each snippet reports when it begins & ends (plus its exit code) on fd 3 which is redirected to a marker file
+    # - timestamps are taken using the printf builtin (e.g no fork, down to the second which is all we report)
+    # - $LOG starts with the abridged log (as of when the step starts) which is also written to $LOG_FILE, the
+    #   session then appends the outcome of each snippet to both (e.g like when running them one by one)
+    # - the step 'timeout' applies to the whole session whose output is spooled into <spool>.log
+    # - in debug mode the output of the session is streamed through live() as it runs (see _step())
+    # - a failing sibling (parallel steps) creates a flag file the session checks before each regular snippet
+    # - return the updated ok flag and whether any snippet was skipped
+    #
+    tick = time.time()
+    flag = path.join(tmp, 'failed-%s' % path.basename(spool))
+    marks = path.join(tmp, 'marks-%s' % path.basename(spool))
+    logs = path.join(tmp, 'log-%s' % path.basename(spool))
+    with open(logs, 'w') as f:
+        f.write(''.join('%s\n' % line for line in abridged))
+
+    with open(marks, 'w'):
+        pass
+
+    snippets = []
+    lines = ['exec 3>>%s' % marks, '__run=%s' % ('1' if ok and not (failed and failed.is_set()) else '')]
+    for n, snippet in enumerate(blk['shell']):
+        tokens = snippet.split(' ')
+        always = tokens[0] == 'no-skip'
+        snippets.append(' '.join(tokens[1:]) if always else snippet)
+        lines += \
+            [
+                'if %s; then' % ('true' if always else '[ -n "$__run" ] && [ ! -e %s ]' % pipes.quote(flag)),
+                'printf -v __begin "%(%s)T" -1',
+                'echo "begin %d $__begin" >&3' % n,
+                '(',
+                snippets[-1],
+                ') 3>&-',
+                '__code=$?',
+                'printf -v __end "%(%s)T" -1',
+                'echo "end %d $__end $__code" >&3' % n,
+                '[ $__code -eq 0 ] && __status=passed || { __status=failed; unset OK __run; }',
+                '__memento="[$__status] "%s" ($((__end - __begin)) seconds, exit code $__code)"' % pipes.quote(_capped(snippets[-1])),
+                'printf "%s\\n" "$__memento" >> "$LOG_FILE"',
+                'LOG="${LOG:+$LOG$\'\\n\'}$__memento"',
+                'fi'
+            ]
+
+    local = {'LOG': '\n'.join(abridged), 'LOG_FILE': logs}
+    if ok:
+        local['OK'] = 'true'
+
+    if 'env' in blk:
+        for key, value in blk['env'].items():
+            local[key] = str(value)
+
+    local.update(var)
+    script = path.join(tmp, 'batch-%s.sh' % path.basename(spool))
+    with open(script, 'w') as f:
+        f.write('\n'.join(lines))
+
+    timeout = tick + float(blk['timeout']) if 'timeout' in blk else None
+    limit = min(timeout, deadline) if timeout and deadline else timeout or deadline
+    #
+    # - a failing sibling (parallel steps) kills the session unless it has 'no-skip' snippets left to run
+    # - if it does, create the flag file as soon as a sibling fails instead : the snippet running at that time
+    #   completes but the regular snippets after it are skipped
+    #
+    always = any(snippet.split(' ')[0] == 'no-skip' for snippet in blk['shell'])
+    over = Event()
+
+    def _flag():
+        while not over.is_set():
+            if failed.wait(0.25):
+                with open(flag, 'w'):
+                    pass
+                return
+
+    if failed and always:
+        flagger = Thread(target=_flag)
+        flagger.daemon = True
+        flagger.start()
+
+    debug = 'debug' in blk and blk['debug']
+    each = (lambda line: live('[batch]   . %s' % line)) if debug and live else None
+    try:
+        code, output, killed = _run(script, cwd, local, '%s.log' % spool, deadline=limit, cancelled=cancelled, failed=None if always else failed, each=each)
+    finally:
+        over.set()
+
+    #
+    # - parse the markers
+    # - a snippet that began but never ended is the one that got killed (or the session died)
+    # - a snippet that never began was skipped, unless bash aborted the session right before it (e.g it failed to
+    #   parse it) in which case it is reported as failed with the exit code of the session
+    #
+    begun = {}
+    ended = {}
+    with open(marks, 'r') as f:
+        for line in f:
+            tokens = line.split()
+            if tokens[0] == 'begin':
+                begun[int(tokens[1])] = float(tokens[2])
+            elif len(tokens) == 4:
+                ended[int(tokens[1])] = (float(tokens[2]), int(tokens[3]))
+
+    died = None
+    if code != 0 and not killed and all(n in ended for n in begun):
+        died = next((n for n in range(len(snippets)) if n > max(begun.keys() + [-1])), None)
+
+    skipped = 0
+    for n, snippet in enumerate(snippets):
+        if n == died:
+            memento = '[failed] %s (0 seconds, exit code %d)' % (_capped(snippet), code)
+            abridged.append(memento)
+            emit(memento)
+            ok = 0
+            if failed:
+                failed.set()
+            continue
+
+        if n not in begun:
+            skipped = 1
+            emit('[skipped] %s' % blk['shell'][n])
+            continue
+
+        stop, status = ended[n] if n in ended else (time.time(), code)
+        outcome = 'passed' if not status else 'failed' if n in ended else killed or 'failed'
+        memento = '[%s] %s (%d seconds, exit code %d)' % (outcome, _capped(snippet), int(stop - begun[n]), status)
+        abridged.append(memento)
+        emit(memento)
+        if status != 0:
+            ok = 0
+            if failed:
+                failed.set()
+
+    #
+    # - a killed session fails the step even if bash itself exited with 0 (e.g only a background process was left)
+    #
+    if killed:
+        ok = 0
+        if begun and all(n in ended for n in begun):
+            memento = '[%s] background process(es) still running after the last snippet' % killed
+            abridged.append(memento)
+            emit(memento)
+
+        if failed:
+            failed.set()
+
+    if debug:
+        emit(*['[batch]   . %s' % line for line in output], streamed=bool(live))
+
+    return ok, skipped
+
+
+def _step(blk, ok, repo, var, tmp, spool, abridged, emit, cache=None, failed=None, deadline=None, cancelled=None, live=None):
+
+    #
+    # - run the shell snippets of one build step in order
+    # - their output is spooled into <spool>-<n>.log, n being the index of the snippet in the step
+    # - emit() is passed the log lines as we go
+    # - live() is an optional callable streaming the output of each snippet line by line as it runs (debug mode
+    #   only), in which case its excerpt is passed to emit() afterwards with streamed=True (e.g only to be kept in
+    #   the build log)
+    # - cache is an optional (redis client, key prefix, ttl in seconds) tuple used to skip the step if its
+    #   inputs already passed (only if it defines either 'inputs' or 'cache_key')
+    # - failed is an optional event used to stop a group of parallel steps as soon as any of them fails : the
+    #   snippet running at that time is killed (unless using the 'no-skip' directive)
+    # - each snippet is killed if it runs for longer than the step 'timeout' (in seconds), if the build deadline
+    #   passes or if the build is cancelled, in which case nothing else runs (not even 'no-skip' snippets)
+    # - return the updated ok flag
+    #
+    emit('- %s' % blk['step'])
+    debug = blk['debug'] if 'debug' in blk else 0
+    cwd = path.join(repo, blk['cwd']) if 'cwd' in blk else repo
+    memo = None
+    if cache and ok and ('inputs' in blk or 'cache_key' in blk):
+        client, prefix, ttl = cache
+        memo = '%s:%s' % (prefix, _digest(blk, cwd, var['COMMIT']))
+        if client.exists(memo):
+            for snippet in blk['shell']:
+                memento = '[cached] %s' % _capped(snippet)
+                abridged.append(memento)
+                emit(memento)
+            return ok
+
+    #
+    # - batch mode requires every snippet to parse : bash would otherwise abort the whole session (skipping whatever
+    #   is left including 'no-skip' snippets), fall back on running them one by one if any does not
+    #
+    batch = 'batch' in blk and blk['batch'] in [True, 'true']
+    if batch and not all(_parses(snippet[8:] if snippet.startswith('no-skip ') else snippet) for snippet in blk['shell']):
+        batch = 0
+        emit('[batch] syntax error, running the snippets one by one')
+
+    if batch:
+        ok, skipped = _batch(blk, ok, cwd, var, tmp, spool, abridged, emit, failed=failed, deadline=deadline, cancelled=cancelled, live=live)
+
+    else:
+
+        skipped = 0
+        for n, snippet in enumerate(blk['shell']):
+
+            tick = time.time()
+            tokens = snippet.split(' ')
+            always = tokens[0] == 'no-skip'
+            over = (deadline and tick > deadline) or (cancelled and cancelled.is_set())
+            if not over and (always or (ok and not (failed and failed.is_set()))):
+
+                #
+                # - if we used the 'no-skip' directive make sure we remove
+                #   it from the snippet
+                #
+                if always:
+                    snippet = ' '.join(tokens[1:])
+
+                #
+                # - set the $OK and $LOG variables
+                # - make sure to use the abridged log to avoid exploding the maximum
+                #   env. variable capacity
+                #
+                local = {'LOG': '\n'.join(abridged)}
+                if ok:
+                    local['OK'] = 'true'
+
+                #
+                # - if block specifies environment variables set them now
+                #
+                if 'env' in blk:
+                    for key, value in blk['env'].items():
+                        local[key] = str(value)
+
+                #
+                # - update the environment we'll pass to the shell
+                # - execute the snippet via a popen()
+                # - each snippet is written to its own script (parallel steps share the same temporary directory)
+                # - only an excerpt of its output is kept in memory, the rest is spooled to disk
+                #
+                local.update(var)
+                capped = _capped(snippet)
+                logger.debug('running <%s>' % capped)
+
+                fd, script = tempfile.mkstemp(suffix='.sh', dir=tmp)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(snippet)
+
+                timeout = tick + float(blk['timeout']) if 'timeout' in blk else None
+                limit = min(timeout, deadline) if timeout and deadline else timeout or deadline
+                each = (lambda line: live('[running]   . %s' % line)) if debug and live else None
+                code, lines, killed = _run(script, cwd, local, '%s-%d.log' % (spool, n), deadline=limit, cancelled=cancelled, failed=None if always else failed, each=each)
+
+                lapse = int(time.time() - tick)
+                status = killed or ('passed' if not code else 'failed')
+                memento = '[%s] %s (%d seconds, exit code %d)' % (status, capped, lapse, code)
+                abridged.append(memento)
+                emit(memento)
+                logger.debug('<%s> -> %d' % (capped, code))
+                if debug:
+                    emit(*['[%s]   . %s' % (status, line) for line in lines], streamed=bool(live))
+
+                #
+                # - switch the ok trigger off if the shell invocation failed or if it was killed (even if bash
+                #   itself exited with 0, e.g only a background process was left)
+                # - all subsequent shell executions will then be ignored unless
+                #   the 'no-skip' directive is used
+                #
+                if code != 0 or killed:
+                    ok = 0
+                    if failed:
+                        failed.set()
+
+            else:
+
+                #
+                # - a build that timed out or got cancelled fails, whether a snippet was running or not
+                #
+                if over:
+                    ok = 0
+
+                skipped = 1
+                emit('[skipped] %s' % snippet)
+
+    #
+    # - remember the step passed if all its snippets ran fine
+    #
+    if memo and ok and not skipped:
+        client.setex(memo, ttl, int(time.time()))
+
+    return ok
+
 
 if __name__ == '__main__':
 
@@ -52,209 +585,632 @@ if __name__ == '__main__':
         settings = json.loads(os.environ['pod'])
         tokens = os.environ['redis'].split(':')
         client = redis.StrictRedis(host=tokens[0], port=int(tokens[1]), db=0)
-        while 1:
 
-            def _slack(line):
+        #
+        # - server-side lua script used to claim a build we just popped in one round-trip
+        # - the entry is stale if pending:<key> does not point to the queue we popped it from (the hook queued
+        #   a newer one somewhere else), in which case we get nothing back
+        # - otherwise clear the pending marker first so that any push from now on queues a new build
+        # - retrieve (and reset) how many builds the hook coalesced into this one
+        # - return whatever git push data is current plus whether a reset was requested
+        #
+        # - KEYS -> pending:<key>, collapsed:<key>, git:<key>, reset:<key>
+        # - ARGV -> queue
+        #
+        claim = client.register_script("""
+            if redis.call('get', KEYS[1]) ~= ARGV[1] then
+                return {}
+            end
+            redis.call('del', KEYS[1])
+            local collapsed = redis.call('getset', KEYS[2], 0)
+            local reset = redis.call('get', KEYS[4])
+            redis.call('del', KEYS[4])
+            return {tonumber(collapsed) or 0, redis.call('get', KEYS[3]), tonumber(reset) or 0}
+        """)
+
+        #
+        # - server-side lua script used to archive a build status into the history for that key
+        # - the status is stored compressed in a hash indexed by sha
+        # - the shas are time-ordered in a sorted set scored by completion time (in milliseconds)
+        # - only keep the last N builds and expire both after D days of inactivity
+        #
+        # - KEYS -> history:<key>, builds:<key>
+        # - ARGV -> sha, completion time, compressed status, N, D (in seconds)
+        #
+        archive = client.register_script("""
+            redis.call('hset', KEYS[2], ARGV[1], ARGV[3])
+            redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+            local evicted = redis.call('zrange', KEYS[1], 0, -tonumber(ARGV[4]) - 1)
+            for _, sha in ipairs(evicted) do
+                redis.call('hdel', KEYS[2], sha)
+            end
+            redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[4]) - 1)
+            redis.call('expire', KEYS[1], ARGV[5])
+            redis.call('expire', KEYS[2], ARGV[5])
+        """)
+
+        #
+        # - retention settings for our build history (# of builds & days)
+        #
+        retention = settings['history'] if 'history' in settings else {}
+        depth = int(retention['builds']) if 'builds' in retention else 50
+        days = int(retention['days']) if 'days' in retention else 30
+        samples = int(retention['samples']) if 'samples' in retention else 100
+
+        #
+        # - server-side lua script used to record how long each phase of a build took (per repository)
+        # - the last N samples of each phase are kept in timings:<repo>:<phase>
+        # - the phase p50/p95 (nearest rank) over those samples plus the last value are then stored as JSON in the
+        #   timings:<repo> hash (one field per phase)
+        # - expire everything after D days of inactivity
+        #
+        # - KEYS -> timings:<repo>, followed by timings:<repo>:<phase> for each phase
+        # - ARGV -> N, D (in seconds), followed by phase/seconds pairs (in the same order as the keys)
+        #
+        timings = client.register_script("""
+            for i = 3, #ARGV, 2 do
+                local key = KEYS[(i - 1) / 2 + 1]
+                redis.call('lpush', key, ARGV[i + 1])
+                redis.call('ltrim', key, 0, tonumber(ARGV[1]) - 1)
+                redis.call('expire', key, ARGV[2])
+                local sorted = {}
+                for _, value in ipairs(redis.call('lrange', key, 0, -1)) do
+                    table.insert(sorted, tonumber(value))
+                end
+                table.sort(sorted)
+                local n = #sorted
+                local js = {p50 = sorted[math.ceil(0.5 * n)], p95 = sorted[math.ceil(0.95 * n)], last = tonumber(ARGV[i + 1]), samples = n}
+                redis.call('hset', KEYS[1], ARGV[i], cjson.encode(js))
+            end
+            redis.call('expire', KEYS[1], ARGV[2])
+        """)
 
-                headers = \
-                    {
-                        'Content-Type': 'application/json'
-                    }
+        #
+        # - our slack relay notifications are queued & posted asynchronously
+        # - they will never block or abort a build
+        #
+        _slack = Notifier('http://%s' % os.environ['slack'])
 
-                requests.post('http://%s' % os.environ['slack'], data=line, headers=headers)
+        #
+        # - we report how long builds waited in each lane via the hook metrics (using the same buckets as the hook)
+        #
+        metrics = Metrics(client, 'metrics:hook')
+        metrics.declare('hook_queue_wait_seconds', 'histogram', 'time spent by builds in the queues per lane', buckets=WAITS)
+
+        #
+        # - our queue is split into priority lanes (highest first), the normal lane being queue-<cluster>-<index>
+        # - blpop() will serve the first non-empty lane in the order we pass them
+        # - to avoid starving the lower lanes every Nth pop goes through them lowest first
+        #
+        def _lanes(qid):
+            shard = 'queue-%s-%d' % (hints['cluster'], qid)
+            return [shard if lane == 'normal' else '%s-%s' % (shard, lane) for lane in LANES]
+
+        qid = int(os.environ['index'])
+        queues = _lanes(qid)
+        shard = queues[LANES.index('normal')]
+        starvation = int(settings['starvation']) if 'starvation' in settings else 5
+        assert starvation > 0, 'starvation must be at least 1'
+        pops = count(1)
+
+        #
+        # - optional work stealing : a worker idle for more than N seconds looks at the queues of the other slaves
+        #   in our cluster and steals from the deepest one
+        # - only steal if the builds queued there would wait for longer than the threshold in seconds (e.g what
+        #   re-cloning a repository we don't have cached would cost)
+        # - the expected wait is estimated using a moving average of our own build times
+        # - stolen entries are moved to processing-<cluster>-<index> until built and put back in their queue if we
+        #   die in the meantime
+        #
+        stealing = settings['stealing'] if 'stealing' in settings else {}
+        idle = int(stealing['idle']) if 'idle' in stealing else 0
+        threshold = float(stealing['threshold']) if 'threshold' in stealing else 120.0
+        siblings = [n for n in range(int(os.environ['slaves'])) if n != qid]
+        processing = 'processing-%s-%d' % (hints['cluster'], qid)
+        average = [60.0]
+
+        #
+        # - server-side lua script used to put a build we stole back into its queue (e.g we died building it)
+        # - the build may have been claimed already (which clears pending:<key>) : re-arm pending:<key> to its
+        #   queue so that the entry is not skipped as superseded once popped again
+        # - drop it if another build is now pending for that key in another queue (it supersedes ours)
+        #
+        # - KEYS -> processing-<cluster>-<index>, pending:<key>, queue
+        # - ARGV -> processing entry, build JSON
+        #
+        requeue = client.register_script("""
+            local pending = redis.call('get', KEYS[2])
+            if not pending or pending == KEYS[3] then
+                redis.call('set', KEYS[2], KEYS[3])
+                redis.call('lpush', KEYS[3], ARGV[2])
+            end
+            redis.call('lrem', KEYS[1], 1, ARGV[1])
+        """)
+
+        #
+        # - server-side lua script used to put a build we popped back at the tail of its queue (e.g another build is
+        #   running in its workspace)
+        # - the build was not claimed yet : pending:<key> still points to its queue so that any push meanwhile is
+        #   coalesced into it
+        # - drop it if another build is now pending for that key in another queue (it supersedes ours)
+        #
+        # - KEYS -> pending:<key>, queue
+        # - ARGV -> build JSON
+        #
+        putback = client.register_script("""
+            if redis.call('get', KEYS[1]) == KEYS[2] then
+                redis.call('rpush', KEYS[2], ARGV[1])
+            end
+        """)
+
+        for entry in client.lrange(processing, 0, -1):
+            js = json.loads(entry)
+            build = json.loads(js['build'])
+            requeue(keys=[processing, 'pending:%s' % build['key'], js['queue']], args=[entry, js['build']])
+            logger.info('re-queued %s -> %s' % (js['build'], js['queue']))
+
+        #
+        # - server-side lua script used to steal the oldest build from the head of a queue (e.g the one its owner
+        #   would pop next) and record it in our processing list in one go
+        # - returns the processing entry or nothing if the queue is empty
+        #
+        # - KEYS -> queue, processing-<cluster>-<index>
+        #
+        steal = client.register_script("""
+            local js = redis.call('lpop', KEYS[1])
+            if not js then
+                return false
+            end
+            local entry = cjson.encode({queue = KEYS[1], build = js})
+            redis.call('lpush', KEYS[2], entry)
+            return entry
+        """)
+
+        #
+        # - we can run several builds at the same time (most of a build is spent waiting on git, the network or
+        #   docker), each worker thread popping & running its own builds
+        # - builds for the same branch/repository share their /tmp/<repo>-<branch> cache : the cache manager holds
+        #   one lock per directory to make sure only one build at a time ever works in there
+        # - optionally hold off popping additional builds while the host is busy (1 minute load average per core
+        #   and/or available memory in MB), one build is always allowed to run
+        # - only one worker at a time may wait on the queues : it checks whether it is admitted first and then
+        #   holds the gate while blocking on the queues (e.g a burst will not start all the workers at once)
+        #
+        concurrency = settings['concurrency'] if 'concurrency' in settings else {}
+        workers = int(concurrency['workers']) if 'workers' in concurrency else 1
+        load = float(concurrency['load']) if 'load' in concurrency else 0.0
+        memory = int(concurrency['memory']) if 'memory' in concurrency else 0
+        running = []
+        busy = []
+        admitted = [0.0]
+        gate = Lock()
+        completed = deque()
+
+        #
+        # - optionally peek at the next N builds queued for us and fetch their commit in the background (at most M
+        #   fetches at a time, each killed after T seconds)
+        #
+        prefetching = settings['prefetch'] if 'prefetch' in settings else {}
+        lookahead = int(prefetching['depth']) if 'depth' in prefetching else 0
+        slots = Semaphore(int(prefetching['fetches']) if 'fetches' in prefetching else 2)
+        patience = int(prefetching['timeout']) if 'timeout' in prefetching else 300
+
+        #
+        # - optional build timeout in seconds (0 to disable)
+        #
+        timeout = int(settings['timeout']) if 'timeout' in settings else 0
+
+        #
+        # - our mirrors & workspaces are evicted least recently used first whenever they use more than the
+        #   specified disk budget in MB (0 to disable)
+        # - the steps that passed are remembered for N days (per repository, indexed by the digest of their inputs)
+        #
+        caching = settings['cache'] if 'cache' in settings else {}
+        budget = int(caching['budget']) if 'budget' in caching else 0
+        ttl = int(caching['days']) * 86400 if 'days' in caching else 7 * 86400
+        cache = Cache(budget=budget, spool=SPOOL)
+
+        def _admit():
+
+            #
+            # - give the last build we admitted a few seconds to weigh in before admitting another one
+            #
+            if not busy or not (load or memory):
+                return 1
+
+            if time.time() - admitted[0] < 10.0:
+                return 0
+
+            if load and os.getloadavg()[0] / cpu_count() > load:
+                return 0
+
+            return not memory or _available() >= memory
+
+        def _build(index, queue, js):
 
             #
-            # - the key passed int the queue is made of the branch & repository tag
+            # - grab the lock of our /tmp/<repo>-<branch> workspace before claiming the build
+            # - if another build is running in there put ours back in its queue without claiming it : pending:<key>
+            #   stays set and any push meanwhile is coalesced into it (e.g it will build whatever sha is current once
+            #   it is popped again)
+            # - return 0 if the workspace was busy
+            #
+            build = json.loads(js)
+            branch = build['branch']
+            started = time.time()
+            safe = build['key'].split(':', 1)[1].replace('/', '-')
+            cached = path.join('/tmp', '%s-%s' % (safe, branch))
+            lock = cache.lock(cached)
+            if not lock.acquire(False):
+                logger.debug('%s is busy, putting the build back @ %s (%s)' % (cached, build['key'], queue))
+                putback(keys=['pending:%s' % build['key'], queue], args=[js])
+                return 0
+
+            #
+            # - claim the build and decode whatever git push data is current
+            # - the hook stores a projection of the git push data, possibly compressed
+            # - JSON always starts with a '{', anything else is zlib
+            # - free our workspace if anything goes wrong from now on until the build starts
             #
-            queue = 'queue-%s-%d' % (hints['cluster'], int(os.environ['index']))
-            logger.debug('waiting on %s...' % queue)
             try:
-                _, js = client.blpop(queue)
-                build = json.loads(js)
-                branch = build['branch']
-                started = time.time()
-                payload = client.get('git:%s' % build['key'])
-                js = json.loads(payload)
+                keys = ['%s:%s' % (prefix, build['key']) for prefix in ['pending', 'collapsed', 'git', 'reset']]
+                claimed = claim(keys=keys, args=[queue])
+                if not claimed:
+                    lock.release()
+                    logger.debug('skipping superseded build @ %s (%s)' % (build['key'], queue))
+                    return 1
+
+                collapsed, payload, reset = claimed
+                js = json.loads(payload if payload.startswith('{') else zlib.decompress(payload))
 
                 #
                 # - extract the various core parameters from the git push json
-                # - prep a directory under /tmp/<repo>-<branch>
-                # - we'll stick to it and clone/checkout the code in there
+                # - we'll stick to our /tmp/<repo>-<branch> directory and clone/checkout the code in there
                 #
-                ok = 1
-                complete = 0
                 cfg = js['repository']
                 tag = cfg['full_name']
                 sha = js['after']
                 last = js['commits'][0]
-                safe = tag.replace('/', '-')
-                abridged = []
-                log = ['- commit %s (%s)' % (sha[0:10], last['message'])]
-                cached = path.join('/tmp', '%s-%s' % (safe, branch))
-                tmp = tempfile.mkdtemp()
+
+            except Exception:
+
+                lock.release()
+                raise
+
+            #
+            # - only account for the builds we actually run (superseded entries never waited for anything)
+            #
+            lane = build['lane'] if 'lane' in build else 'normal'
+            if 'queued' in build:
+                metrics.observe('hook_queue_wait_seconds', started - build['queued'], cluster=hints['cluster'], lane=lane)
+
+            ok = 1
+            complete = 0
+            abridged = []
+            log = []
+            spans = []
+            buffered = []
+            produced = [0]
+            pushed = [0]
+            streaming = Lock()
+
+            @contextmanager
+            def _phase(name):
+
+                #
+                # - time one phase of the build
+                # - each span records when it started (relative to when we popped the build) and how long it took
+                #
+                tick = time.time()
                 try:
+                    yield
+                finally:
+                    spans.append({'phase': name, 'start': round(tick - started, 3), 'seconds': round(time.time() - tick, 3)})
 
-                    _slack(':rocket: %s #%d: build starting for *%s* (%s, hash _%s_ "%s")...' % (hints['cluster'], int(os.environ['index']), tag, branch, sha[0:10], last['message']))
+            if 'queued' in build:
+                spans.append({'phase': 'queue', 'start': round(build['queued'] - started, 3), 'seconds': round(started - build['queued'], 3)})
 
-                    try:
+            def _live(*lines):
 
-                        #
-                        # - if requested wipe out the directory first
-                        # - this will force a git clone
-                        #
-                        if 'reset' in build and build['reset']:
-                            try:
-                                shutil.rmtree(cached)
-                                logger.info('wiped out %s' % cached)
-                            except IOError:
-                                pass
-
-                        repo = path.join(cached, cfg['name'])
-                        if not path.exists(repo):
-
-                            #
-                            # - the repo is not in our cache
-                            # - git clone it
-                            #
-                            os.makedirs(cached)
-                            logger.info('cloning %s [%s]' % (tag, branch))
-                            url = 'https://%s' % cfg['git_url'][6:]
-                            code, _ = shell('git clone -b %s --single-branch %s' % (branch, url), cwd=cached)
+                #
+                # - stream lines to log:<id> without adding them to the build log (e.g the output of a snippet as it
+                #   runs or the lines of each member of a parallel group as they come)
+                # - this is called while reading the output of snippets : only buffer them (the poller flushes them
+                #   every second), up to STREAMED lines per build
+                #
+                with streaming:
+                    room = STREAMED - produced[0]
+                    if room > 0:
+                        buffered.extend(lines[:room])
+                        if len(lines) >= room:
+                            buffered.append('... live output capped at %d lines ...' % STREAMED)
+
+                    produced[0] += len(lines)
+
+            def _flush(pipe=None):
+
+                #
+                # - push whatever lines are buffered to log:<id> in redis (one list per build) and notify whoever is
+                #   tailing it
+                # - if a pipeline is passed just add the commands to it
+                #
+                with streaming:
+                    if not buffered:
+                        return
+
+                    pushed[0] += len(buffered)
+                    batch = pipe or client.pipeline(transaction=False)
+                    batch.rpush('log:%s' % ident, *buffered)
+                    batch.expire('log:%s' % ident, LEASE)
+                    batch.publish('log:%s' % ident, pushed[0])
+                    del buffered[:]
+                    if not pipe:
+                        batch.execute()
+
+            def _log(*lines, **kwargs):
+
+                #
+                # - append to the build log
+                # - mirror each line to log:<id> right away unless it was streamed already (streamed=True)
+                #
+                if not lines:
+                    return
+
+                log.extend(lines)
+                if not kwargs.get('streamed'):
+                    with streaming:
+                        buffered.extend(lines)
+
+                _flush()
+
+            #
+            # - we hold our workspace lock, it is therefore safe to point tail:<key> to our build id (we would
+            #   otherwise hide the log of the build in progress)
+            #
+            mirror = path.join('/tmp', '%s.git' % safe)
+            tmp = tempfile.mkdtemp()
+            running.append(index)
+            ident = '%s-%d' % (sha[0:10], started * 1000)
+            deadline = time.time() + timeout if timeout else None
+            cancelled = Event()
+            done = Event()
+            poller = None
+            try:
+
+                #
+                # - the output of our last build is spooled under /opt/slave/spool/<repo>-<branch>
+                #
+                spool = path.join(SPOOL, '%s-%s' % (safe, branch))
+                shutil.rmtree(spool, ignore_errors=True)
+                os.makedirs(spool)
+
+                #
+                # - record our build id under running:<key> so that it can be cancelled (see POST /cancel on the hook)
+                # - poll cancel:<key> until the build is over (it holds the id of the build to cancel)
+                # - flush whatever live output is buffered at the same time
+                # - running:<key>, tail:<key> and log:<id> are leased for LEASE seconds and the poller keeps renewing
+                #   them : should we crash they expire instead of pointing to a build that will never complete
+                #
+                client.set('running:%s' % build['key'], ident, ex=LEASE)
+
+                def _poll():
+                    while not done.wait(1.0):
+                        try:
+                            _flush()
+                            pipe = client.pipeline(transaction=False)
+                            pipe.get('cancel:%s' % build['key'])
+                            for key in ['running:%s' % build['key'], 'tail:%s' % build['key'], 'log:%s' % ident]:
+                                pipe.expire(key, LEASE)
+
+                            stop = pipe.execute()[0]
+                            if not cancelled.is_set() and stop == ident:
+                                logger.info('cancelling %s @ %s' % (tag, sha[0:10]))
+                                cancelled.set()
+
+                        except Exception as failure:
+
+                            logger.warning('unable to poll cancel:%s or flush log:%s (%s)' % (build['key'], ident, diagnostic(failure)))
+
+                poller = Thread(target=_poll)
+                poller.daemon = True
+                poller.start()
+
+                client.set('tail:%s' % build['key'], ident, ex=LEASE)
+                _log('- commit %s (%s)' % (sha[0:10], last['message']))
+                if collapsed:
+                    _log('- superseded %d queued build(s)' % collapsed)
+
+                _slack(':rocket: %s #%d.%d: build starting for *%s* (%s, hash _%s_ "%s")...' % (hints['cluster'], int(os.environ['index']), index, tag, branch, sha[0:10], last['message']))
+
+                try:
+
+                    #
+                    # - if requested wipe out the directory first
+                    # - this will force a git clone (from the mirror)
+                    #
+                    if reset:
+                        try:
+                            shutil.rmtree(cached)
+                            logger.info('wiped out %s' % cached)
+                        except OSError:
+                            pass
+
+                    #
+                    # - all the branches of a repository share one bare mirror under /tmp/<repo>.git
+                    # - let the cache manager know we are using both (it will not evict the mirror while we hold
+                    #   the workspace lock)
+                    # - a prefetch may hold the mirror : wait for it unless we time out or get cancelled meanwhile
+                    # - clone it if needed, otherwise fetch the branch we were pushed to unless the commit is already
+                    #   there (see _prefetch())
+                    # - use a bare clone (heads & tags only) rather than --mirror which would also copy every pull
+                    #   request ref GitHub advertises (_fetch() asks for whatever branch or commit it needs anyway)
+                    # - never prune it (the workspaces borrow their objects from it)
+                    #
+                    repo = path.join(cached, cfg['name'])
+                    cache.touch(cached, mirror, path.exists(repo))
+                    with _phase('mirror'), _locked(cache.lock(mirror), deadline=deadline, cancelled=cancelled):
+                        url = 'https://%s' % cfg['git_url'][6:]
+                        if not path.exists(mirror):
+                            logger.info('mirroring %s' % tag)
+                            code = _git('git clone --bare %s %s' % (url, mirror), deadline=deadline, cancelled=cancelled)
                             assert code == 0, 'unable to clone %s' % url
-                        else:
+                            shell('git config gc.pruneExpire never', cwd=mirror)
 
-                            #
-                            # - the repo is already in there
-                            # - git pull
-                            #
-                            shell('git pull', cwd=repo)
+                        _fetch(mirror, branch, sha, deadline=deadline, cancelled=cancelled)
 
-                        #
-                        # - checkout the specified commit hash
-                        #
-                        logger.info('checkout @ %s' % sha[0:10])
-                        code, _ = shell('git checkout %s' % sha, cwd=repo)
-                        assert code == 0, 'unable to checkout %s (wrong credentials and/or git issue ?)' % sha[0:10]
+                    if not path.exists(repo):
 
                         #
-                        # - prep a little list of env. variable to pass down to the shell
-                        #   snippets we'll run
+                        # - the branch is not in our cache
+                        # - clone it from the mirror, borrowing its objects (e.g nothing is copied)
                         #
-                        var = \
-                            {
-                                'HOST':             os.environ['HOST'],
-                                'BRANCH':           branch,
-                                'COMMIT':           sha,
-                                'COMMIT_SHORT':     sha[0:10],
-                                'MESSAGE':          last['message'],
-                                'TAG':              re.sub(r'[^a-zA-Z0-9=]', '-','%s-%s' % (branch, sha[0:10])),
-                                'TIMESTAMP':        last['timestamp']
-                            }
+                        os.makedirs(cached)
+                        logger.info('cloning %s [%s]' % (tag, branch))
+                        with _phase('clone'):
+                            code = _git('git clone --shared --no-checkout %s %s' % (mirror, cfg['name']), cwd=cached, deadline=deadline, cancelled=cancelled)
+                        assert code == 0, 'unable to clone %s' % mirror
 
-                        #
-                        # - go look for integration.yml
-                        # - if not found abort
-                        #
-                        with open(path.join(repo, 'integration.yml'), 'r') as f:
-                            yml = yaml.load(f)
+                    #
+                    # - point origin back to the actual repository (the objects are still borrowed from the mirror
+                    #   via the git alternates) so that whatever the shell snippets fetch or push goes to github
+                    # - do it upon each build so that workspaces cloned before this was in place get fixed as well
+                    #
+                    code, _ = shell('git remote set-url origin %s' % url, cwd=repo)
+                    assert code == 0, 'unable to set the origin of %s' % repo
 
-                        #
-                        # - the yaml can either be an array or a dict
-                        # - force it to an array for convenience
-                        # - otherwise loop and execute each shell snippet in order
-                        #
-                        js = yml if isinstance(yml, list) else [yml]
-                        for blk in js:
-                            log += ['- %s' % blk['step']]
-                            debug = blk['debug'] if 'debug' in blk else 0
-                            cwd = path.join(repo, blk['cwd']) if 'cwd' in blk else repo
-                            for snippet in blk['shell']:
-
-                                tick = time.time()
-                                tokens = snippet.split(' ')
-                                always = tokens[0] == 'no-skip'
-                                if always or ok:
-
-                                    #
-                                    # - if we used the 'no-skip' directive make sure we remove
-                                    #   it from the snippet
-                                    #
-                                    if always:
-                                        snippet = ' '.join(tokens[1:])
-
-                                    #
-                                    # - set the $OK and $LOG variables
-                                    # - make sure to use the abridged log to avoid exploding the maximum
-                                    #   env. variable capacity
-                                    #
-                                    local = {'LOG': '\n'.join(abridged)}
-                                    if ok:
-                                        local['OK'] = 'true'
-
-                                    #
-                                    # - if block specifies environment variables set them now
-                                    #
-                                    if 'env' in blk:
-                                        for key, value in blk['env'].items():
-                                            local[key] = str(value)
-
-                                    #
-                                    # - update the environment we'll pass to the shell
-                                    # - execute the snippet via a popen()
-                                    #
-                                    local.update(var)
-                                    capped = snippet if len(snippet) < 32 else '%s...' % snippet[:64]
-                                    capped = capped.replace('\n', ' ')
-                                    logger.debug('running <%s>' % capped)
-
-                                    script = path.join(tmp, 'script.sh')
-                                    with file(script, mode='w') as f:
-                                        f.write(snippet)
-
-                                    code, lines = shell('/bin/bash %s' % script, cwd=cwd, env=local)
-
-                                    lapse = int(time.time() - tick)
-                                    status = 'passed' if not code else 'failed'
-                                    memento = '[%s] %s (%d seconds, exit code %d)' % (status, capped, lapse, code)
-                                    abridged += [memento]
-                                    log += [memento]
-                                    logger.debug('<%s> -> %d' % (capped, code))
-                                    if debug:
-                                        log += ['[%s]   . %s' % (status, line) for line in lines]
-
-                                    #
-                                    # - switch the ok trigger off if the shell invocation failed
-                                    # - all subsequent shell executions will then be ignored unless
-                                    #   the 'no-skip' directive is used
-                                    #
-                                    if code != 0:
-                                        ok = 0
-
-                                else:
-                                    log += ['[skipped] %s' % snippet]
+                    #
+                    # - checkout the specified commit hash
+                    #
+                    logger.info('checkout @ %s' % sha[0:10])
+                    with _phase('checkout'):
+                        code = _git('git checkout %s' % sha, cwd=repo, deadline=deadline, cancelled=cancelled)
+                    assert code == 0, 'unable to checkout %s (wrong credentials and/or git issue ?)' % sha[0:10]
 
-                        #
-                        # - we went through the whole thing
-                        #
-                        complete = 1
+                    #
+                    # - prep a little list of env. variable to pass down to the shell
+                    #   snippets we'll run
+                    #
+                    var = \
+                        {
+                            'HOST':             os.environ['HOST'],
+                            'BRANCH':           branch,
+                            'COMMIT':           sha,
+                            'COMMIT_SHORT':     sha[0:10],
+                            'MESSAGE':          last['message'],
+                            'TAG':              re.sub(r'[^a-zA-Z0-9=]', '-','%s-%s' % (branch, sha[0:10])),
+                            'TIMESTAMP':        last['timestamp']
+                        }
 
-                    except AssertionError as failure:
+                    #
+                    # - go look for integration.yml
+                    # - if not found abort
+                    #
+                    with _phase('yaml'), open(path.join(repo, 'integration.yml'), 'r') as f:
+                        yml = yaml.load(f)
 
-                        log += ['* %s' % str(failure)]
+                    #
+                    # - the yaml can either be an array or a dict
+                    # - force it to an array for convenience
+                    # - otherwise loop and execute each step in order
+                    # - a step defining 'parallel' is a group of steps run concurrently : the output of each member
+                    #   is streamed as it runs (prefixed by the member name), captured separately and then merged in
+                    #   the build log in declaration order once the group is over
+                    # - the group fails fast, e.g as soon as one member fails the others will skip whatever snippets
+                    #   they have left (unless using the 'no-skip' directive)
+                    # - steps that passed already with the same inputs are skipped (the index lives in redis)
+                    # - each step (or group) is timed as a step:<name> phase
+                    #
+                    js = yml if isinstance(yml, list) else [yml]
+                    control = \
+                        {
+                            'cache': (client, 'cache:%s' % tag, ttl),
+                            'deadline': deadline,
+                            'cancelled': cancelled
+                        }
 
-                    except IOError:
+                    for n, blk in enumerate(js):
+                        label = 'step:%s' % (blk['step'] if 'step' in blk else '#%d' % n)
+                        if 'parallel' not in blk:
+                            with _phase(label):
+                                ok = _step(blk, ok, repo, var, tmp, path.join(spool, '%d' % n), abridged, _log, live=_live, **control)
+                            continue
 
-                        log += ['* unable to load integration.yml (missing from the repo ?)']
+                        members = blk['parallel']
+                        _log('- %s' % blk['step'] if 'step' in blk else '- %d parallel steps' % len(members))
+                        failed = Event()
+                        outputs = [[] for _ in members]
+                        trails = [list(abridged) for _ in members]
+                        results = [0] * len(members)
 
-                    except YAMLError as failure:
+                        def _member(m):
 
-                        log += ['* invalid YAML syntax']
+                            name = members[m]['step'] if 'step' in members[m] else '#%d' % m
+                            prefixed = lambda lines: ['%s | %s' % (name, line) for line in lines]
 
-                    except Exception as failure:
+                            def _emit(*lines, **kwargs):
+                                outputs[m].extend(lines)
+                                if not kwargs.get('streamed'):
+                                    _live(*prefixed(lines))
 
-                        log += ['* unexpected condition -> %s' % diagnostic(failure)]
+                            try:
+                                stream = lambda line: _live(*prefixed([line]))
+                                results[m] = _step(members[m], ok, repo, var, tmp, path.join(spool, '%d.%d' % (n, m)), trails[m], _emit, failed=failed, live=stream, **control)
 
-                finally:
+                            except Exception as failure:
+
+                                _emit('* unexpected condition -> %s' % diagnostic(failure))
+                                failed.set()
+
+                        with _phase(label):
+                            threads = [Thread(target=_member, args=(m,)) for m in range(len(members))]
+                            for thread in threads:
+                                thread.start()
+
+                            for thread in threads:
+                                thread.join()
+
+                        base = len(abridged)
+                        for m in range(len(members)):
+                            abridged.extend(trails[m][base:])
+                            _log(*outputs[m], streamed=True)
+
+                        ok = ok and all(results)
+
+                    #
+                    # - a build that got cancelled or timed out always fails (even if it happened in between snippets)
+                    #
+                    if cancelled.is_set():
+                        ok = 0
+                        _log('* build cancelled')
+
+                    elif deadline and time.time() > deadline:
+                        ok = 0
+                        _log('* build timed out after %d seconds' % timeout)
+
+                    #
+                    # - we went through the whole thing
+                    #
+                    complete = 1
+
+                except AssertionError as failure:
+
+                    _log('* %s' % str(failure))
+
+                except IOError:
+
+                    _log('* unable to load integration.yml (missing from the repo ?)')
+
+                except YAMLError as failure:
+
+                    _log('* invalid YAML syntax')
+
+                except Exception as failure:
+
+                    _log('* unexpected condition -> %s' % diagnostic(failure))
+
+            finally:
+
+                try:
 
                     #
                     # - make sure to cleanup our temporary directory
@@ -268,26 +1224,292 @@ if __name__ == '__main__':
                     if not complete:
                         logger.error('build interrupted (%s)' % log[-1])
 
-                    seconds = int(time.time() - started)
+                    now = time.time()
+                    seconds = int(now - started)
+                    average[0] = 0.8 * average[0] + 0.2 * seconds
                     status = \
                         {
                             'ok': ok and complete,
                             'sha': sha,
                             'log': log,
-                            'seconds': seconds
+                            'seconds': seconds,
+                            'completed': int(now * 1000),
+                            'collapsed': collapsed,
+                            'cancelled': cancelled.is_set(),
+                            'phases': spans
                         }
-                    client.set('status:%s' % build['key'], json.dumps(status))
+
+                    #
+                    # - sum the spans per phase (e.g a step name may be used more than once) plus the total
+                    #
+                    totals = {}
+                    for span in spans:
+                        totals[span['phase']] = totals.get(span['phase'], 0.0) + span['seconds']
+                    totals['total'] = round(now - started, 3)
+
+                    #
+                    # - store the status and notify anybody long-polling on it in one round-trip
+                    # - store its <sha>-<completed> tag next to it so that the hook can answer polls without parsing it
+                    # - archive it as well into our build history
+                    # - add our phase timings to the rolling aggregates for that repository
+                    # - terminate log:<id> with our EOF marker and let it expire after a day (tail:<key> as well)
+                    # - we are not running anymore
+                    # - stop the poller first so that it does not renew our leases past this point
+                    #
+                    done.set()
+                    if poller:
+                        poller.join()
+
+                    completed.append((now, status['ok']))
+                    serialized = json.dumps(status)
+                    pipe = client.pipeline()
+                    pipe.set('status:%s' % build['key'], serialized)
+                    pipe.set('etag:%s' % build['key'], '%s-%d' % (sha, status['completed']))
+                    pipe.publish('status:%s' % build['key'], sha)
+                    keys = ['history:%s' % build['key'], 'builds:%s' % build['key']]
+                    archive(keys=keys, args=[sha, status['completed'], zlib.compress(serialized), depth, days * 86400], client=pipe)
+                    phases = sorted(totals.items())
+                    keys = ['timings:%s' % tag] + ['timings:%s:%s' % (tag, phase) for phase, _ in phases]
+                    timings(keys=keys, args=[samples, days * 86400] + [value for pair in phases for value in pair], client=pipe)
+                    _flush(pipe)
+                    pipe.rpush('log:%s' % ident, EOF)
+                    pipe.expire('log:%s' % ident, 86400)
+                    pipe.expire('tail:%s' % build['key'], 86400)
+                    pipe.publish('log:%s' % ident, pushed[0] + 1)
+                    pipe.delete('running:%s' % build['key'], 'cancel:%s' % build['key'])
+                    pipe.execute()
                     logger.info('%s @ %s -> %s %d seconds' % (tag, sha[0:10], 'ok' if status['ok'] else 'ko', seconds))
 
-                icon = ':white_check_mark:' if ok and complete else ':no_entry:'
-                _slack(':rocket: %s *%s* (%s, hash _%s_) ran in *%ds* with log:' % (icon, tag, branch, sha[0:10], seconds))
-                _slack('```%s```' % '\n'.join(log))
+                finally:
+
+                    #
+                    # - update the size of our cache directories
+                    # - free our workspace for the next build
+                    # - evict whatever we need to stay within budget
+                    #
+                    done.set()
+                    cache.update(cached, mirror)
+                    running.remove(index)
+                    lock.release()
+                    cache.evict()
+
+            icon = ':white_check_mark:' if ok and complete else ':no_entry:'
+            _slack(':rocket: %s *%s* (%s, hash _%s_) ran in *%ds* with log:' % (icon, tag, branch, sha[0:10], seconds))
+            _slack('```%s```' % '\n'.join(log))
+            return 1
+
+        def _steal():
+
+            #
+            # - fetch the depth of all the lanes of our siblings in one round-trip
+            # - pick the deepest sibling and its highest non-empty lane
+            # - assume our siblings run as many builds concurrently as we do
+            #
+            if not siblings:
+                return None
+
+            pipe = client.pipeline(transaction=False)
+            for sibling in siblings:
+                for queue in _lanes(sibling):
+                    pipe.llen(queue)
+
+            replies = pipe.execute()
+            depths = {sibling: replies[n * len(LANES):(n + 1) * len(LANES)] for n, sibling in enumerate(siblings)}
+            deepest = max(siblings, key=lambda sibling: sum(depths[sibling]))
+            wait = sum(depths[deepest]) * average[0] / workers
+            if wait <= threshold:
+                return None
+
+            queue = next(queue for queue, depth in zip(_lanes(deepest), depths[deepest]) if depth)
+            entry = steal(keys=[queue, processing])
+            if not entry:
+                return None
+
+            logger.info('stealing from %s (%d queued, ~%d seconds wait)' % (queue, sum(depths[deepest]), wait))
+            metrics.inc('hook_builds_stolen_total', cluster=hints['cluster'])
+            return queue, json.loads(entry)['build'], entry
+
+        def _prefetch():
+
+            #
+            # - peek at the next N builds in our lanes (highest first) and look their git payload up
+            # - for each repository we already mirror fetch the pushed commit in the background so that the
+            #   build will not have to wait on the network once popped
+            # - only the bare mirror is updated (never a workspace) and we skip any mirror that is busy (e.g
+            #   being fetched by a build or being evicted)
+            # - cap the # of concurrent fetches
+            #
+            while 1:
+                time.sleep(5.0)
+                try:
+                    pipe = client.pipeline(transaction=False)
+                    for queue in queues:
+                        pipe.lrange(queue, 0, lookahead - 1)
+
+                    upcoming = [json.loads(js) for entries in pipe.execute() for js in entries][:lookahead]
+                    if not upcoming:
+                        continue
+
+                    payloads = client.mget(['git:%s' % build['key'] for build in upcoming])
+                    for build, payload in zip(upcoming, payloads):
+                        if payload is None:
+                            continue
+
+                        js = json.loads(payload if payload.startswith('{') else zlib.decompress(payload))
+                        mirror = path.join('/tmp', '%s.git' % js['repository']['full_name'].replace('/', '-'))
+                        if not path.exists(mirror) or not slots.acquire(False):
+                            continue
+
+                        thread = Thread(target=_fill, args=(mirror, build['branch'], js['after']))
+                        thread.daemon = True
+                        thread.start()
+
+                except Exception as failure:
+
+                    logger.warning('unable to prefetch (%s)' % diagnostic(failure))
+
+        def _fill(mirror, branch, sha):
+
+            #
+            # - fetch under the mirror lock (a build waiting on it gives up once its deadline passes)
+            # - only re-compute the size of the mirror if we actually fetched something
+            #
+            lock = cache.lock(mirror)
+            try:
+                if lock.acquire(False):
+                    try:
+                        fetched = _fetch(mirror, branch, sha, deadline=time.time() + patience)
+                    finally:
+                        lock.release()
+
+                    if fetched:
+                        logger.info('prefetched %s @ %s' % (mirror, sha[0:10]))
+                        metrics.inc('hook_prefetches_total', cluster=hints['cluster'])
+                        cache.update(mirror)
 
             except Exception as failure:
 
-                _slack(':no_entry: internal failure: "_%s_"' % diagnostic(failure))
-                logger.error('unexpected condition -> %s' % diagnostic(failure))
+                logger.warning('unable to prefetch %s (%s)' % (mirror, diagnostic(failure)))
+
+            finally:
+                slots.release()
+
+        def _report():
+
+            #
+            # - dump our statistics every 30 seconds : the depth of our lanes, what we are running, what we
+            #   built over the last hour and what happened to our slack notifications
+            # - the pod sanity check simply reads the file (e.g it does not need to talk to redis)
+            #
+            while 1:
+                try:
+                    now = time.time()
+                    while completed and completed[0][0] < now - 3600:
+                        completed.popleft()
+
+                    pipe = client.pipeline(transaction=False)
+                    for queue in queues:
+                        pipe.llen(queue)
+
+                    stats = \
+                        {
+                            'queued': dict(zip(LANES, pipe.execute())),
+                            'running': len(running),
+                            'workers': workers,
+                            'builds': len(completed),
+                            'failed': sum(1 for _, ok in list(completed) if not ok),
+                            'average': int(average[0]),
+                            'notifier': _slack.stats()
+                        }
+
+                    with open(STATS, 'w') as f:
+                        f.write(json.dumps(stats))
+
+                except Exception as failure:
+
+                    logger.warning('unable to dump our statistics (%s)' % diagnostic(failure))
+
+                time.sleep(30.0)
+
+        def _work(index):
+
+            while 1:
+
+                #
+                # - grab the gate and wait until we are allowed to take on another build
+                # - the key passed in the queue is made of the branch & repository tag
+                # - if we stay idle for a while try to steal a build from a sibling
+                # - if other builds are running and the host limits are enabled only block for a few seconds at a
+                #   time and check again whether we are still admitted (the host may have become busy meanwhile)
+                # - we are busy as soon as we got something, release the gate for the next worker
+                #
+                try:
+                    with gate:
+                        while 1:
+                            while not _admit():
+                                time.sleep(5.0)
+
+                            short = busy and (load or memory)
+                            logger.debug('worker #%d waiting on %s...' % (index, shard))
+                            popped = client.blpop(queues if next(pops) % starvation else queues[::-1], timeout=5 if short else idle)
+                            if popped or not short:
+                                break
+
+                        stolen = None if popped else _steal()
+                        if not popped and not stolen:
+                            continue
+
+                        busy.append(index)
+                        admitted[0] = time.time()
+
+                    try:
+                        if popped:
+                            built = _build(index, *popped)
+
+                        else:
+                            queue, js, entry = stolen
+                            try:
+                                built = _build(index, queue, js)
+                            finally:
+                                client.lrem(processing, 1, entry)
+
+                    finally:
+                        busy.remove(index)
+
+                    #
+                    # - if we had to put the build back (its workspace is busy) give the other builds queued for us
+                    #   a chance to be popped before we spin on it again
+                    #
+                    if not built:
+                        time.sleep(1.0)
+
+                except Exception as failure:
+
+                    _slack(':no_entry: internal failure: "_%s_"' % diagnostic(failure))
+                    logger.error('unexpected condition -> %s' % diagnostic(failure))
+
+        #
+        # - start prefetching if enabled
+        # - start dumping our statistics
+        # - start our workers and block on them
+        #
+        if lookahead:
+            prefetcher = Thread(target=_prefetch)
+            prefetcher.daemon = True
+            prefetcher.start()
+
+        reporter = Thread(target=_report)
+        reporter.daemon = True
+        reporter.start()
+
+        threads = [Thread(target=_work, args=(n,)) for n in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
 
+        logger.info('running up to %d concurrent build(s)' % workers)
+        for thread in threads:
+            thread.join()
     except Exception as failure:
 
         logger.fatal('unexpected condition -> %s' % diagnostic(failure))